@@ -0,0 +1,89 @@
+"""
+Benchmark of the ePD (pdf_type 3) CRPS: per-cell properscoring (apply_ufunc vectorize=True)
+against the vectorised piecewise-linear kernel, on a synthetic year of forecasts.
+
+    python example/benchmark_crps.py --basetimes 730 --prognosis-periods 240 --pdf-index 100
+"""
+import argparse
+import time
+
+import numpy as np
+import properscoring as ps
+import xarray as xr
+from scipy.stats import norm
+
+from verif.models.scores import crps_piecewise_linear
+
+
+def synthetic_epd(n_basetime, n_prognosis_period, n_pdf_index, seed=0):
+    """ Synthetic ePD-like dataset: tabulated pdf/cdf of Gaussians (pdf_parameter 0: x, 1: value)
+    """
+    rng = np.random.default_rng(seed)
+    shape = (n_basetime, n_prognosis_period)
+    loc = rng.normal(15., 5., shape)
+    scale = rng.uniform(0.5, 3., shape)
+    x = loc[..., None] + scale[..., None] * np.linspace(-5., 5., n_pdf_index)
+    dims = ('basetime', 'prognosis_period', 'pdf_index')
+    pdf = xr.concat([xr.DataArray(x, dims=dims),
+                     xr.DataArray(norm.pdf(x, loc[..., None], scale[..., None]), dims=dims)], dim='pdf_parameter')
+    cdf = xr.concat([xr.DataArray(x, dims=dims),
+                     xr.DataArray(norm.cdf(x, loc[..., None], scale[..., None]), dims=dims)], dim='pdf_parameter')
+    obs = xr.DataArray(rng.normal(loc, scale), dims=dims[:2])
+    return xr.Dataset({'pdf': pdf, 'cdf': cdf, 'obs': obs})
+
+
+def crps_properscoring(dt_ds):
+    return xr.apply_ufunc(ps.crps_ensemble,
+                          dt_ds['obs'],
+                          dt_ds['pdf'].isel(pdf_parameter=0),
+                          dt_ds['pdf'].isel(pdf_parameter=1),
+                          exclude_dims=set(('pdf_index',)),
+                          input_core_dims=[[], ["pdf_index"], ["pdf_index"]],
+                          vectorize=True)
+
+
+def crps_vectorised(dt_ds):
+    return xr.apply_ufunc(crps_piecewise_linear,
+                          dt_ds['obs'],
+                          dt_ds['cdf'].isel(pdf_parameter=0),
+                          dt_ds['cdf'].isel(pdf_parameter=1),
+                          exclude_dims=set(('pdf_index',)),
+                          input_core_dims=[[], ["pdf_index"], ["pdf_index"]])
+
+
+def timeit(func, *args, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ePD CRPS benchmark")
+    parser.add_argument("--basetimes", type=int, default=730)
+    parser.add_argument("--prognosis-periods", type=int, default=240)
+    parser.add_argument("--pdf-index", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    dt_ds = synthetic_epd(args.basetimes, args.prognosis_periods, args.pdf_index)
+    n_cells = args.basetimes * args.prognosis_periods
+    print(f"{n_cells} cells x {args.pdf_index} pdf_index")
+
+    t_ps, crps_ps = timeit(crps_properscoring, dt_ds, repeat=1)
+    t_vec, crps_vec = timeit(crps_vectorised, dt_ds, repeat=args.repeat)
+    print(f"properscoring (per cell): {t_ps:8.3f} s")
+    print(f"vectorised kernel       : {t_vec:8.3f} s  (x{t_ps / t_vec:.0f})")
+
+    # reference: exact Gaussian CRPS (the tabulated cdf is a Gaussian)
+    loc = dt_ds['cdf'].isel(pdf_parameter=0).mean('pdf_index')
+    scale = (dt_ds['cdf'].isel(pdf_parameter=0, pdf_index=-1) - loc) / 5.
+    crps_ref = ps.crps_gaussian(dt_ds['obs'].values, loc.values, scale.values)
+    print(f"mean |crps - gaussian crps|: properscoring {np.abs(crps_ps.values - crps_ref).mean():.2e}, "
+          f"vectorised {np.abs(crps_vec.values - crps_ref).mean():.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -24,7 +24,8 @@ def main():
                           "dask",
                           "flox",
                         #   "dt-output",
-                          "properscoring"]
+                          "properscoring"],
+        entry_points={"console_scripts": ["verif-batch=verif.batch:main"]},
     )
 
 if __name__ == "__main__":
@@ -5,9 +5,13 @@ from os import environ
 # environment variables
 LOGGING_LEVEL = environ.get("LOGGING_LEVEL", "info")
 
+# handler added to the root logger (once per process)
+_handler = None
+
 # logger function
 def get_loggers():
     """config the logger format"""
+    global _handler
 
     if LOGGING_LEVEL == "info":
         log_lev = INFO
@@ -16,14 +20,14 @@ def get_loggers():
     elif LOGGING_LEVEL == "error":
         log_lev = ERROR
 
-    formatter = Formatter("%(asctime)s - %(levelname)s - %(message)s")
-    ch = StreamHandler()
-    ch.setLevel(log_lev)
-    ch.setFormatter(formatter)
-
     logger = getLogger()
     logger.setLevel(log_lev)
-    logger.addHandler(ch)
+    if _handler is None:
+        formatter = Formatter("%(asctime)s - %(levelname)s - %(message)s")
+        _handler = StreamHandler()
+        _handler.setLevel(log_lev)
+        _handler.setFormatter(formatter)
+        logger.addHandler(_handler)
     for ignore in (
         "boto",
         "boto3",
@@ -0,0 +1,269 @@
+"""
+Batch verification runner: stations x model variables verified on a process pool
+(or in a pipeline prefetching the next units while the current one is scored),
+with one output file per unit and a manifest of completed units to resume a run.
+
+Example:
+    verif-batch --stations 93439 93106 --start 2022-01-01 --end 2022-12-31 \
+                --model DLITE --vars TTTTT fff10 --output ./verification/2022 --workers 8
+"""
+
+import argparse
+import datetime
+import json
+import os
+import tempfile
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import s3fs
+
+from . import get_loggers
+from .models.dt_verif import VerifDT, NoForecastData, fetch_dt_output, filter_forecasts
+from .pipeline import PrefetchPipeline
+
+
+logger = get_loggers()
+
+
+def unit_path(output, model, model_var, station):
+    """ Output path of a (station, model var) unit: {output}/{model}/{model_var}/{station}.nc
+    """
+    return f"{output.rstrip('/')}/{model}/{model_var}/{station}.nc"
+
+
+def read_manifest(manifest_path):
+    """ Completed units of the manifest (JSON lines), the last record of a unit wins
+    Returns:
+        dict: (station, model_var) -> manifest record
+    """
+    completed = {}
+    if not os.path.exists(manifest_path):
+        return completed
+    with open(manifest_path, "r") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                completed[(record["station"], record["model_var"])] = record
+    return completed
+
+
+def write_dataset(ds, path):
+    """ Write a dataset to a local or S3 path (through a temporary file owned by the worker)
+    """
+    if path.startswith("s3://"):
+        with tempfile.NamedTemporaryFile(suffix=".nc") as tmp:
+            ds.to_netcdf(tmp.name)
+            s3fs.S3FileSystem().put(tmp.name, path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        ds.to_netcdf(path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+
+def make_verif(station, model_var, config):
+    """ VerifDT of a (station, model var) unit (the obs are queried)
+    """
+    return VerifDT(station_id=station,
+                   dt_start=config["dt_start"],
+                   dt_end=config["dt_end"],
+                   obs_source=config["obs_source"],
+                   model=config["model"],
+                   model_vars=[model_var],
+                   fcast_window=config["fcast_window"],
+                   freq=config["freq"],
+                   api_key=config["api_key"],
+                   metrics=config.get("metrics"),
+                   basetime_block_days=config.get("basetime_block_days"),
+                   basetime_hours=config.get("basetime_hours"),
+                   max_prognosis_period=config.get("max_prognosis_period"))
+
+
+def run_unit(station, model_var, config):
+    """ Verify one (station, model var) unit and write its output (runs in a worker process)
+        Fetch errors other than "no data" are raised (the unit is failed, and retried on resume)
+    Returns:
+        str: output path, None if no data
+    """
+    verif_dt = make_verif(station, model_var, config)
+    if verif_dt.obs_ds is None:
+        return
+    verif_ds_list = verif_dt.verify_vars()
+    if not verif_ds_list:
+        return
+
+    path = unit_path(config["output"], config["model"], model_var, station)
+    write_dataset(verif_ds_list[0], path)
+    return path
+
+
+def fetch_unit(unit, config):
+    """ I/O stage of the pipeline: obs and forecasts of a (station, model var) unit
+    Returns:
+        tuple: VerifDT (with its obs), forecasts loaded in memory (None if no data)
+    """
+    station, model_var = unit
+    verif_dt = make_verif(station, model_var, config)
+    if verif_dt.obs_ds is None:
+        return verif_dt, None
+    try:
+        dt_ds = fetch_dt_output(station, config["dt_start"], config["dt_end"], model_var, config["model"])
+    except NoForecastData:
+        print(f"No {config['model']} data for station {station}/{model_var}")
+        return verif_dt, None
+    dt_ds = filter_forecasts(dt_ds, config.get("basetime_hours"), config.get("max_prognosis_period"))
+    return verif_dt, dt_ds.load()
+
+
+def score_unit(unit, fetched, config):
+    """ Compute stage of the pipeline: score a (station, model var) unit and write its output
+    Returns:
+        str: output path, None if no data
+    """
+    station, model_var = unit
+    verif_dt, dt_ds = fetched
+    if dt_ds is None or dt_ds.sizes["basetime"] == 0:
+        return
+    verif_ds = verif_dt.score_forecasts(model_var, dt_ds)
+
+    path = unit_path(config["output"], config["model"], model_var, station)
+    write_dataset(verif_ds, path)
+    return path
+
+
+def iter_units_pool(todo, config, workers):
+    """ (unit, path, error) of the units verified on a process pool, as they complete
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_unit, station, model_var, config): (station, model_var)
+                   for station, model_var in todo}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as error:
+                yield futures[future], None, error
+
+
+def run_batch(stations, model_vars, config, manifest_path, workers=4, prefetch=0, io_workers=4,
+              retry_no_data=False):
+    """ Verify stations x model_vars on a process pool
+        Units already done in the manifest are skipped (and the units without data, unless retry_no_data),
+        and a failing unit does not stop the others (it is not recorded, so it is retried on resume).
+        With prefetch > 0, the units are scored in this process instead, while a pool of io_workers
+        threads fetches the obs and forecasts of the next `prefetch` units (I/O-compute overlap).
+    Args:
+        stations (list): WMO station ids
+        model_vars (list): model variables to verify
+        config (dict): dt_start, dt_end, obs_source, model, fcast_window, freq, api_key, output,
+                       metrics, basetime_block_days, basetime_hours, max_prognosis_period (optional)
+        manifest_path (str): manifest of the completed units (JSON lines)
+        workers (int): number of worker processes
+        prefetch (int): pipelined mode: number of units fetched ahead of the scored one (0: process pool),
+                        the whole forecast range of a unit is fetched (no basetime_block_days)
+        io_workers (int): pipelined mode: number of I/O threads
+        retry_no_data (bool): verify again the units recorded without data
+    Returns:
+        dict: number of units per status ('done', 'no_data', 'failed', 'skipped')
+    """
+    if prefetch > 0 and config.get("basetime_block_days"):
+        raise ValueError("basetime_block_days is not supported in the pipelined mode (prefetch > 0)")
+
+    completed = read_manifest(manifest_path)
+    if retry_no_data:
+        completed = {unit: record for unit, record in completed.items() if record["status"] == "done"}
+    units = [(station, model_var) for station in stations for model_var in model_vars]
+    todo = [unit for unit in units if unit not in completed]
+    counts = {"done": 0, "no_data": 0, "failed": 0, "skipped": len(units) - len(todo)}
+    logger.info(f"{len(todo)} units to verify, {counts['skipped']} already completed")
+
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+    if prefetch > 0:
+        pipeline = PrefetchPipeline(lambda unit: fetch_unit(unit, config),
+                                    lambda unit, fetched: score_unit(unit, fetched, config),
+                                    prefetch=prefetch, io_workers=io_workers)
+        results = pipeline.run(todo)
+    else:
+        pipeline = None
+        results = iter_units_pool(todo, config, workers)
+
+    with open(manifest_path, "a") as manifest:
+        for (station, model_var), path, error in results:
+            if error is not None:
+                logger.error(f"{station}/{model_var} failed:\n"
+                             f"{''.join(traceback.format_exception(type(error), error, error.__traceback__))}")
+                counts["failed"] += 1
+                continue
+            record = {"station": station, "model_var": model_var,
+                      "finished": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                      "status": "done" if path else "no_data", "path": path}
+            counts[record["status"]] += 1
+            # only the parent process writes the manifest
+            manifest.write(json.dumps(record) + "\n")
+            manifest.flush()
+
+    if pipeline is not None:
+        logger.info(f"Pipeline stages: {pipeline.stats}")
+    logger.info(f"Batch verification: {counts}")
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch verification of DeepThought forecasts (stations x variables)")
+    parser.add_argument("--stations", nargs="+", required=True,
+                        help="WMO station ids, or a JSON file with a list of station ids")
+    parser.add_argument("--start", required=True, help="start basetime (YYYY-MM-DD)")
+    parser.add_argument("--end", required=True, help="end basetime (YYYY-MM-DD)")
+    parser.add_argument("--model", required=True, help="model to verify ('ePD', 'DLITE')")
+    parser.add_argument("--vars", nargs="+", required=True, help="model variables to verify (ex TTTTT)")
+    parser.add_argument("--output", required=True, help="output directory or S3 prefix")
+    parser.add_argument("--obs-source", default="DDB_obs", help="obs data source ('DDB_obs', 'API_obs')")
+    parser.add_argument("--fcast-window", type=int, default=16, help="days of obs after the end basetime")
+    parser.add_argument("--freq", default="hourly", help="obs frequency ('hourly', '10min')")
+    parser.add_argument("--api-key", default=os.environ.get("OBS_API_KEY"), help="1 min obs API key")
+    parser.add_argument("--metrics", nargs="+", default=None,
+                        help="metrics to compute (default p_obs cp_obs negloglik crps, ex --metrics crps for a backfill)")
+    parser.add_argument("--basetime-block-days", type=int, default=None,
+                        help="score the forecasts by blocks of basetimes of N days (bounds the memory per worker, "
+                             "process pool mode only: not with --prefetch)")
+    parser.add_argument("--basetime-hours", nargs="+", type=int, default=None,
+                        help="basetime hours to verify (ex 0 12)")
+    parser.add_argument("--max-prognosis-period", type=int, default=None,
+                        help="number of prognosis periods to verify (ex 85)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--prefetch", type=int, default=0,
+                        help="pipelined mode: units fetched ahead while the current one is scored (0: process pool), "
+                             "the whole forecast range of a unit is loaded (not with --basetime-block-days)")
+    parser.add_argument("--io-workers", type=int, default=4, help="pipelined mode: number of I/O threads")
+    parser.add_argument("--retry-no-data", action="store_true",
+                        help="verify again the units recorded without data in the manifest")
+    parser.add_argument("--manifest", default=None,
+                        help="manifest of completed units (default ./verif_manifest_{model}.jsonl)")
+    args = parser.parse_args()
+    if args.prefetch > 0 and args.basetime_block_days:
+        parser.error("--basetime-block-days is not supported with --prefetch (the pipeline loads whole units)")
+
+    stations = args.stations
+    if len(stations) == 1 and stations[0].endswith(".json"):
+        with open(stations[0], "r") as f:
+            stations = json.load(f)
+
+    config = dict(dt_start=datetime.datetime.strptime(args.start, "%Y-%m-%d"),
+                  dt_end=datetime.datetime.strptime(args.end, "%Y-%m-%d"),
+                  obs_source=args.obs_source,
+                  model=args.model,
+                  fcast_window=args.fcast_window,
+                  freq=args.freq,
+                  api_key=args.api_key,
+                  output=args.output,
+                  metrics=args.metrics,
+                  basetime_block_days=args.basetime_block_days,
+                  basetime_hours=args.basetime_hours,
+                  max_prognosis_period=args.max_prognosis_period)
+    manifest_path = args.manifest or f"./verif_manifest_{args.model}.jsonl"
+
+    run_batch(stations, args.vars, config, manifest_path, workers=args.workers,
+              prefetch=args.prefetch, io_workers=args.io_workers, retry_no_data=args.retry_no_data)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+from os import environ
+
+# local forecast cache settings (no cache if DT_CACHE_DIR is not set)
+DT_CACHE_DIR = environ.get("DT_CACHE_DIR", None)
+DT_CACHE_MAX_GB = float(environ.get("DT_CACHE_MAX_GB", 20))
+# months of basetimes ending less than DT_CACHE_RECENT_DAYS ago may still change and are not cached
+DT_CACHE_RECENT_DAYS = int(environ.get("DT_CACHE_RECENT_DAYS", 1))
@@ -0,0 +1,79 @@
+"""
+Alignment of observation series on forecast valid times
+"""
+import numpy as np
+import pandas as pd
+
+
+def match_validtime(obs_time, validtime, tolerance=None):
+    """Index of the observation time matching each forecast valid time.
+    Valid times are deduplicated (they recur across basetimes), resolved with a
+    sorted-index searchsorted on int64 timestamps, then broadcast back.
+
+    Args:
+        obs_time (np.ndarray): observation times (datetime64), sorted and unique
+        validtime (np.ndarray): forecast valid times (datetime64, any shape, NaT allowed)
+        tolerance (str or timedelta, optional): if set, match the nearest observation
+                                                within the tolerance instead of the exact time
+
+    Returns:
+        np.ndarray: index in obs_time for each valid time (-1 if no match), shape of validtime
+    """
+    obs_ns = np.asarray(obs_time).astype('datetime64[ns]').astype(np.int64)
+    validtime = np.asarray(validtime).astype('datetime64[ns]')
+    if obs_ns.size == 0:
+        return np.full(validtime.shape, -1, dtype=np.int64)
+
+    unique_ns, inverse = np.unique(validtime.astype(np.int64), return_inverse=True)
+    pos = np.searchsorted(obs_ns, unique_ns)
+
+    if tolerance is None:
+        pos = np.clip(pos, 0, obs_ns.size - 1)
+        unique_index = np.where(obs_ns[pos] == unique_ns, pos, -1)
+    else:
+        tolerance_ns = pd.Timedelta(tolerance).value
+        left = np.clip(pos - 1, 0, obs_ns.size - 1)
+        right = np.clip(pos, 0, obs_ns.size - 1)
+        distance_left = np.abs(unique_ns - obs_ns[left])
+        distance_right = np.abs(obs_ns[right] - unique_ns)
+        nearest = np.where(distance_right <= distance_left, right, left)
+        distance = np.minimum(distance_left, distance_right)
+        unique_index = np.where(distance <= tolerance_ns, nearest, -1)
+
+    index = unique_index[inverse.reshape(validtime.shape)]
+    index[np.isnat(validtime)] = -1
+    return index
+
+
+def align_obs(obs_time, obs_values, validtime, tolerance=None):
+    """Observation values at forecast valid times (NaN where there is no observation).
+
+    Args:
+        obs_time (np.ndarray): observation times (datetime64, dim time)
+        obs_values (np.ndarray): observation values, shape (..., time); the leading dims
+                                 (ex station) are matched with the leading dims of validtime
+        validtime (np.ndarray): forecast valid times, shape (..., *) (ex (basetime, prognosis_period))
+        tolerance (str or timedelta, optional): nearest observation within the tolerance
+                                                instead of the exact time
+
+    Returns:
+        np.ndarray: observation values, shape of validtime
+    """
+    obs_time = np.asarray(obs_time).astype('datetime64[ns]')
+    obs_values = np.asarray(obs_values, dtype=np.float64)
+    validtime = np.asarray(validtime)
+
+    # sorted unique observation times for the searchsorted
+    order = np.argsort(obs_time, kind='stable')
+    keep = np.ones(order.shape, dtype=bool)
+    keep[1:] = obs_time[order][1:] != obs_time[order][:-1]
+    order = order[keep]
+    index = match_validtime(obs_time[order], validtime, tolerance)
+
+    # leading dims of the obs flattened, NaN column for the missing matches
+    n_lead = int(np.prod(obs_values.shape[:-1], dtype=np.int64))
+    values = obs_values.reshape(n_lead, -1)[:, order]
+    values = np.concatenate([values, np.full((n_lead, 1), np.nan)], axis=1)
+    index = np.where(index < 0, values.shape[1] - 1, index).reshape(n_lead, -1)
+
+    return np.take_along_axis(values, index, axis=1).reshape(validtime.shape)
@@ -0,0 +1,208 @@
+"""
+Local on-disk cache for the DeepThought forecasts read from S3 (get_dt_output).
+
+Forecasts are stored as one netCDF file per (station, model var, dt_kind, basetime month), at a
+content address {root}/{hash[:2]}/{hash}.nc derived from the key. Only complete months (ended more
+than DT_CACHE_RECENT_DAYS ago) are cached, the requested part of the other months is fetched on each
+call. The least recently used files are evicted once the cache is above its disk budget (DT_CACHE_MAX_GB).
+"""
+
+import datetime
+import hashlib
+import os
+import threading
+
+import pandas as pd
+import xarray as xr
+
+from . import DT_CACHE_DIR, DT_CACHE_MAX_GB, DT_CACHE_RECENT_DAYS
+from .. import get_loggers
+
+
+logger = get_loggers()
+
+
+class NoForecastData(LookupError):
+    """ No forecasts for a station/model var in a basetime range (any other fetch error is a failure)
+    """
+
+
+class ForecastCache:
+    """Month partitioned, content-addressed netCDF cache of DeepThought forecasts with LRU eviction.
+
+    Args:
+        root (str): cache root directory.
+        max_bytes (int): disk budget of the cache in bytes.
+        recent_days (int): months ending less than recent_days ago are not cached.
+
+    Attributes:
+        hits (int): number of (station, var, kind, month) requested and served from the cache.
+        misses (int): number of (station, var, kind, month) requested and fetched.
+
+    Methods:
+        get(station, model_var, dt_kind, dt_start, dt_end, fetch): forecasts, fetching the missing months.
+        evict(): remove the least recently used files above the disk budget.
+    """
+
+    def __init__(self, root: str, max_bytes: int, recent_days: int = DT_CACHE_RECENT_DAYS):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.recent = datetime.timedelta(days=recent_days)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def path(self, station, model_var, dt_kind, month):
+        """ Content address of a (station, model var, dt_kind, basetime month) partition
+        """
+        key = f"{station}|{model_var}|{dt_kind}|{month.year:04d}-{month.month:02d}"
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.root, digest[:2], f"{digest}.nc")
+
+    def _is_complete(self, month):
+        """ A month of basetimes is not updated anymore once ended for recent_days
+        """
+        month_end = month.end_time.to_pydatetime().replace(microsecond=0)
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return month_end < now - self.recent
+
+    def load(self, path):
+        """ Forecasts of a cached partition, loaded in memory (the file is touched as recently used)
+        """
+        with xr.open_dataset(path) as ds:
+            ds = ds.load()
+        os.utime(path)
+        return ds
+
+    def store(self, path, dt_ds):
+        """ Write a month partition (through a temporary file), then evict above the disk budget
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            dt_ds.to_netcdf(tmp_path)
+            os.replace(tmp_path, path)
+        except Exception as error:
+            logger.warning(f"Forecast cache: could not store {path}: {error}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self.evict()
+
+    def evict(self):
+        """ Remove the least recently used files until the cache fits in the disk budget
+        """
+        with self._lock:
+            files = []
+            for dir_path, _, file_names in os.walk(self.root):
+                for file_name in file_names:
+                    if file_name.endswith(".nc"):
+                        file_path = os.path.join(dir_path, file_name)
+                        stat = os.stat(file_path)
+                        files.append((stat.st_mtime, stat.st_size, file_path))
+            total = sum(size for _, size, _ in files)
+            for _, size, file_path in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                logger.debug(f"Forecast cache: evict {file_path}")
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def get(self, station, model_var, dt_kind, dt_start: datetime.datetime, dt_end: datetime.datetime, fetch):
+        """ Forecasts of the basetimes in [dt_start, dt_end], fetching only the months not in cache
+            (complete months are fetched whole so that they can be cached)
+        Args:
+            station (str): WMO station id.
+            model_var (str): DeepThought predictand (ex 'TTTTT')
+            dt_kind (str): either "ePD" or "DLITE"
+            dt_start (datetime.datetime): The start basetime.
+            dt_end (datetime.datetime): The end basetime.
+            fetch (callable): fetch(start, end) returning the forecasts of the basetimes in [start, end],
+                              raising NoForecastData if there are none
+        Returns:
+            xarray: DeepThought output
+        Raises:
+            NoForecastData: no forecasts in [dt_start, dt_end] (other fetch errors are raised as is)
+        """
+        months = list(pd.period_range(dt_start, dt_end, freq="M"))
+        cached = {month: self.path(station, model_var, dt_kind, month) for month in months}
+        cached = {month: path for month, path in cached.items()
+                  if self._is_complete(month) and os.path.exists(path)}
+
+        # consecutive missing months fetched in one call
+        missing_runs = []
+        for month in months:
+            if month in cached:
+                continue
+            if missing_runs and missing_runs[-1][-1] + 1 == month:
+                missing_runs[-1].append(month)
+            else:
+                missing_runs.append([month])
+        with self._lock:
+            self.hits += len(cached)
+            self.misses += len(months) - len(cached)
+
+        month_ds = {}
+        for month, path in cached.items():
+            try:
+                month_ds[month] = self.load(path)
+            except (FileNotFoundError, OSError):
+                # evicted meanwhile
+                missing_runs.append([month])
+
+        no_data = []
+        for run in missing_runs:
+            run_start = run[0].start_time.to_pydatetime()
+            run_end = run[-1].end_time.to_pydatetime().replace(microsecond=0)
+            # months not complete yet are not cached: only their requested part is fetched
+            if not self._is_complete(run[0]):
+                run_start = max(run_start, dt_start)
+            if not self._is_complete(run[-1]):
+                run_end = min(run_end, dt_end)
+            logger.debug(f"Forecast cache miss {station}/{model_var}/{dt_kind}: {run_start} - {run_end}")
+            try:
+                run_ds = fetch(run_start, run_end)
+            except NoForecastData as error:
+                logger.debug(f"No {dt_kind} data for {station}/{model_var}: {run_start} - {run_end} ({error})")
+                no_data.append(f"{run_start} - {run_end}")
+                continue
+            basetime_months = pd.to_datetime(run_ds["basetime"].values).to_period("M")
+            for month in run:
+                part_ds = run_ds.isel(basetime=basetime_months == month)
+                if part_ds.sizes["basetime"] == 0:
+                    continue
+                month_ds[month] = part_ds
+                if self._is_complete(month):
+                    self.store(self.path(station, model_var, dt_kind, month), part_ds)
+
+        if not month_ds:
+            raise NoForecastData(f"No {dt_kind} data for station {station}/{model_var}")
+        if no_data:
+            logger.warning(f"No {dt_kind} data for station {station}/{model_var}: {', '.join(no_data)}")
+        parts = [month_ds[month] for month in sorted(month_ds)]
+        dt_ds = parts[0] if len(parts) == 1 else xr.concat(parts, dim="basetime", data_vars="minimal",
+                                                            coords="minimal", combine_attrs="override")
+        return dt_ds.sel(basetime=slice(dt_start, dt_end))
+
+    def stats(self):
+        """ Hit/miss counters (per requested station/var/kind/month)
+        """
+        return {"hits": self.hits, "misses": self.misses}
+
+
+# process-wide cache (shared hit/miss counters)
+_cache = None
+
+
+def get_forecast_cache():
+    """ Forecast cache, None if no cache dir is set (env DT_CACHE_DIR)
+    """
+    global _cache
+    if not DT_CACHE_DIR:
+        return None
+    if _cache is None:
+        _cache = ForecastCache(DT_CACHE_DIR, int(DT_CACHE_MAX_GB * 1024**3))
+    return _cache
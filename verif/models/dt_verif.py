@@ -3,19 +3,213 @@ Functions for verifying DeepThought ePD/DLITE outputs
 
 """
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from scipy.stats import norm
 import pandas as pd
 import xarray as xr
-import properscoring as ps
 from dt_output import get_dt_output
 
 from verif.obs.utils import get_obs_serie
-from verif.models.verif import VerifModelStation
+from verif.models.verif import VerifModelStation, VerifModelStations
+from verif.models.align import align_obs
+from verif.models.cache import get_forecast_cache, NoForecastData
+from verif.models.scores import crps_piecewise_linear, interp_bracket, interp_rows, interp_pdf_cdf, gaussian_scores
 
 
 
-def verify_dt_ouput(station, dt_start, dt_end, predictand, dt_kind):
+# probabilistic metrics computed by default
+METRICS = ['p_obs', 'cp_obs', 'negloglik', 'crps']
+
+# scoring rules of each DeepThought distribution type (attrs pdf_type): list of (metrics, rule)
+SCORING_RULES = {}
+
+
+def scoring_rule(pdf_types, metrics):
+    """Register a scoring rule for DeepThought distribution types.
+        The rule is called as rule(dt_ds, obs_name, model_var, metrics, dtype, dask) with the
+        requested metrics it provides, and returns a dict metric -> DataArray.
+        It is only called if at least one of its metrics is requested.
+
+    Args:
+        pdf_types (list): distribution types (dt_ds.attrs['pdf_type']) handled by the rule
+        metrics (list): metrics provided by the rule
+    """
+    def register(rule):
+        for pdf_type in pdf_types:
+            SCORING_RULES.setdefault(pdf_type, []).append((list(metrics), rule))
+        return rule
+    return register
+
+
+@scoring_rule([3], ['p_obs', 'cp_obs', 'negloglik'])
+def tabulated_density(dt_ds, obs_name, model_var, metrics, dtype, dask):
+    """ Full prob distribution (ePD): observation probabiltiy and cumulative proba (for PIT histogram),
+        one batched interpolation of all the rows (bracket search shared by the pdf and the cdf)
+    """
+    scores = {}
+    if 'p_obs' in metrics or 'negloglik' in metrics:
+        p_obs, cp_obs = xr.apply_ufunc(interp_pdf_cdf,
+                        dt_ds[obs_name],
+                        dt_ds['pdf'].isel(pdf_parameter=0),
+                        dt_ds['pdf'].isel(pdf_parameter=1),
+                        dt_ds['cdf'].isel(pdf_parameter=0),
+                        dt_ds['cdf'].isel(pdf_parameter=1),
+                        exclude_dims=set(('pdf_index',)),
+                        input_core_dims=[[], ["pdf_index"], ["pdf_index"], ["pdf_index"], ["pdf_index"]],
+                        output_core_dims=[[], []],
+                        dask=dask,
+                        output_dtypes=[np.float64, np.float64])
+        scores['p_obs'] = p_obs.astype(np.float32)
+        scores['cp_obs'] = cp_obs.astype(np.float32)
+        # negative log likelihood
+        scores['negloglik'] = -np.log(scores['p_obs'])
+    else:
+        # PIT only: cdf interpolation
+        scores['cp_obs'] = xr.apply_ufunc(lambda obs, x, cdf: interp_rows(interp_bracket(obs, x), cdf),
+                        dt_ds[obs_name],
+                        dt_ds['cdf'].isel(pdf_parameter=0),
+                        dt_ds['cdf'].isel(pdf_parameter=1),
+                        exclude_dims=set(('pdf_index',)),
+                        input_core_dims=[[], ["pdf_index"], ["pdf_index"]],
+                        dask=dask,
+                        output_dtypes=[np.float64]).astype(np.float32)
+    return scores
+
+
+@scoring_rule([3], ['crps'])
+def tabulated_crps(dt_ds, obs_name, model_var, metrics, dtype, dask):
+    """ Full prob distribution (ePD): crps, exact for the piecewise-linear cdf (whole arrays at once)
+    """
+    crps = xr.apply_ufunc(crps_piecewise_linear,
+                    dt_ds[obs_name],
+                    dt_ds['cdf'].isel(pdf_parameter=0),
+                    dt_ds['cdf'].isel(pdf_parameter=1),
+                    exclude_dims=set(('pdf_index',)),
+                    input_core_dims=[[], ["pdf_index"], ["pdf_index"]],
+                    dask=dask,
+                    output_dtypes=[np.float64])
+    return {'crps': crps.astype(np.float32)}
+
+
+@scoring_rule([0, 8], ['p_obs', 'cp_obs', 'negloglik', 'crps'])
+def gaussian(dt_ds, obs_name, model_var, metrics, dtype, dask):
+    """ Normal distribution (DLITE, mean + sd): observation probabiltiy, cumulative proba,
+        log likelihood and crps in one pass (fused gaussian kernel)
+    """
+    p_obs, cp_obs, loglik, crps = xr.apply_ufunc(gaussian_scores,
+                    dt_ds[obs_name],
+                    dt_ds[f'{model_var}_PDF_parameter'].isel(pdf_parameter=0, pdf_index=0),
+                    dt_ds[f'{model_var}_PDF_parameter'].isel(pdf_parameter=1, pdf_index=0),
+                    kwargs=dict(dtype=dtype),
+                    output_core_dims=[[], [], [], []],
+                    dask=dask,
+                    output_dtypes=[dtype] * 4)
+    return {'p_obs': p_obs.astype(np.float32),
+            'cp_obs': cp_obs.astype(np.float32),
+            'negloglik': (-loglik).astype(np.float32),
+            'crps': crps.astype(np.float32)}
+
+
+def score_dt(dt_ds, obs_name, model_var, float32=False, metrics=None):
+    """Probabilistic scores of DeepThought forecasts against aligned observations
+        (over all the basetime/prognosis_period cells and any extra dim, ex station),
+        with the scoring rules registered for the distribution type (dt_ds.attrs['pdf_type']):
+            - Observation probability and cumulative probabilty (for PIT histogram)
+            - Observation negative log likelihood
+            - Continuous Rank Probability Score
+
+    Args:
+        dt_ds (xarray): DeepThought output with the observations aligned on validtime
+        obs_name (str): name of the observation variable in dt_ds
+        model_var (str): DeepThought predictand (ex 'TTTTT')
+        float32 (bool): compute the gaussian scores in float32 (outputs are float32 anyway)
+        metrics (list): metrics to compute (default METRICS: p_obs, cp_obs, negloglik, crps)
+
+    Returns:
+        xarray: dt_ds with the requested metrics
+                (lazy if dt_ds is chunked with dask, see VerifDT basetime_chunks)
+    """
+    metrics = METRICS if metrics is None else list(metrics)
+    pdf_type = dt_ds.attrs['pdf_type']
+    if pdf_type not in SCORING_RULES:
+        raise ValueError(f"No scoring rule for pdf_type {pdf_type}")
+    provided = {metric for rule_metrics, _ in SCORING_RULES[pdf_type] for metric in rule_metrics}
+    if set(metrics) - provided:
+        raise ValueError(f"Metrics {sorted(set(metrics) - provided)} not available for pdf_type {pdf_type}")
+
+    # chunked (dask) dataset: build the scoring graph lazily, one task per chunk
+    dask = 'parallelized' if dt_ds.chunks else 'forbidden'
+    dtype = np.float32 if float32 else np.float64
+
+    for rule_metrics, rule in SCORING_RULES[pdf_type]:
+        requested = [metric for metric in rule_metrics if metric in metrics]
+        if not requested:
+            continue
+        scores = rule(dt_ds, obs_name, model_var, requested, dtype, dask)
+        for metric in requested:
+            dt_ds[metric] = scores[metric]
+
+    return dt_ds
+
+
+def fetch_dt_output(station, dt_start, dt_end, model_var, dt_kind, use_cache=True):
+    """DeepThought forecasts from the S3 archive (get_dt_output), through the local forecast
+        cache if enabled (env DT_CACHE_DIR)
+
+    Args:
+        station (str): WMO station id.
+        dt_start (datetime.datetime): The start basetime.
+        dt_end (datetime.datetime): The end basetime.
+        model_var (str): DeepThought predictand requested (ex 'TTTTT')
+        dt_kind (str): either "ePD" or "DLITE"
+        use_cache (bool): use the local forecast cache if enabled
+
+    Returns:
+        xarray: DeepThought output
+
+    Raises:
+        NoForecastData: no forecasts for the station/model var in [dt_start, dt_end]
+                        (any other error of get_dt_output is raised as is)
+    """
+    def fetch(start, end):
+        try:
+            dt_ds = get_dt_output(station, start, end, model_var, source='S3', dt_kind=dt_kind, output=None)
+        except OSError as error:
+            # no file in the archive for the range (missing key, or no files to open)
+            if isinstance(error, FileNotFoundError) or str(error) == "no files to open":
+                raise NoForecastData(f"No {dt_kind} data for station {station}/{model_var}: {start} - {end}") from error
+            raise
+        if dt_ds is None or dt_ds.sizes.get('basetime', 0) == 0:
+            raise NoForecastData(f"No {dt_kind} data for station {station}/{model_var}: {start} - {end}")
+        return dt_ds
+
+    cache = get_forecast_cache() if use_cache else None
+    if cache is None:
+        return fetch(dt_start, dt_end)
+    return cache.get(station, model_var, dt_kind, dt_start, dt_end, fetch)
+
+
+def filter_forecasts(dt_ds, basetime_hours=None, max_prognosis_period=None):
+    """Keep only the forecast cells to verify (before the obs alignment and the scoring,
+        and before the data is read if dt_ds is lazily opened)
+
+    Args:
+        dt_ds (xarray): DeepThought output
+        basetime_hours (list, optional): basetime hours to keep (ex [0, 12])
+        max_prognosis_period (int, optional): number of prognosis periods to keep (ex 85 for a 85h max lead)
+
+    Returns:
+        xarray: filtered DeepThought output
+    """
+    if basetime_hours is not None:
+        dt_ds = dt_ds.isel(basetime=pd.to_datetime(dt_ds['basetime'].values).hour.isin(basetime_hours))
+    if max_prognosis_period is not None:
+        dt_ds = dt_ds.isel(prognosis_period=slice(0, max_prognosis_period))
+    return dt_ds
+
+
+def verify_dt_ouput(station, dt_start, dt_end, predictand, dt_kind, obs_tolerance=None, metrics=None,
+                    basetime_hours=None, max_prognosis_period=None):
     """Verify probabilistic DeepThought forecast a time period
         Calculate probabilistic metrics for each basetime/prognosis_period:
             - Observation probability and cumulative probabilty (for PIT histogram)
@@ -28,6 +222,11 @@ def verify_dt_ouput(station, dt_start, dt_end, predictand, dt_kind):
         dt_end (datetime.datetime): The end datetime.
         predictand (str): DeepThought predictand requested (ex 'TTTTT')
         dt_kind (str): either "ePD" or "DLITE"
+        obs_tolerance (str, optional): match the nearest obs within the tolerance (ex '5min')
+                                       instead of the exact valid time
+        metrics (list, optional): metrics to compute (default p_obs, cp_obs, negloglik, crps)
+        basetime_hours (list, optional): basetime hours to verify (ex [0, 12])
+        max_prognosis_period (int, optional): number of prognosis periods to verify (ex 85)
 
     Returns:
         xarray: Deepthought summary outputs and prob metrics
@@ -36,10 +235,11 @@ def verify_dt_ouput(station, dt_start, dt_end, predictand, dt_kind):
 
     # get deepthought forecast from the archive
     try:
-        dt_ds = get_dt_output(station, dt_start, dt_end, predictand, source='S3', dt_kind=dt_kind, output=None)
-    except:
-        print(f"No ePD data for station {station}")
+        dt_ds = fetch_dt_output(station, dt_start, dt_end, predictand, dt_kind)
+    except NoForecastData:
+        print(f"No {dt_kind} data for station {station}/{predictand}")
         return
+    dt_ds = filter_forecasts(dt_ds, basetime_hours, max_prognosis_period)
 
     # obs_ds = get_obs(station, dt1, dt2, predictand) # need to query DDB + QC + interp... TODO
     # need to return a serie of obs, index datetime
@@ -57,92 +257,18 @@ def verify_dt_ouput(station, dt_start, dt_end, predictand, dt_kind):
                             dt_end + datetime.timedelta(days=16), # add 16 days to cover the prognosis period
                             freq='hourly')
     
-    # observation mapping
-    # mapping = dict(zip(pd.to_datetime(obs_ds.index), obs_ds[predictand]))
-    mapping = dict(zip(pd.to_datetime(obs_ds.time.values), obs_ds.values))
-    map_func = np.vectorize(lambda x: mapping.get(x, np.nan))
-
-    # apply the mapping function to the 'validtime' variable 
-    obs_predictand = map_func(pd.to_datetime(dt_ds['validtime'].values)).astype(np.float32)
+    # observation mapping on the 'validtime' variable
+    obs_predictand = align_obs(obs_ds.time.values, obs_ds.values,
+                               dt_ds['validtime'].values, obs_tolerance).astype(np.float32)
     # assign with the same dimensions
     dt_ds[f'obs_{predictand}'] = (('basetime', 'prognosis_period'), obs_predictand)
     # add metadata
     dt_ds[f'obs_{predictand}'].attrs = obs_ds.attrs
 
-    # if dt_kind=='ePD':
-    # full prob distribution
-    if dt_ds.attrs['pdf_type']==3:
-        # observation probabiltiy
-        p_obs = xr.apply_ufunc(np.interp,
-                        dt_ds[f'obs_{predictand}'],
-                        dt_ds['pdf'].isel(pdf_parameter=0),
-                        dt_ds['pdf'].isel(pdf_parameter=1),
-                        exclude_dims=set(('pdf_index',)),
-                        input_core_dims=[[], ["pdf_index"], ["pdf_index"]],
-                        vectorize=True)
-        dt_ds['p_obs'] = p_obs.astype(np.float32)
-
-        # negative log likelihood
-        dt_ds['negloglik'] = -np.log(dt_ds['p_obs'])
-
-        # cumulative proba (for PIT histogram)
-        cp_obs = xr.apply_ufunc(np.interp,
-                        dt_ds[f'obs_{predictand}'],
-                        dt_ds['cdf'].isel(pdf_parameter=0),
-                        dt_ds['cdf'].isel(pdf_parameter=1),
-                        exclude_dims=set(('pdf_index',)),
-                        input_core_dims=[[], ["pdf_index"], ["pdf_index"]],
-                        vectorize=True)
-        dt_ds['cp_obs'] = cp_obs.astype(np.float32)
-
-        # crps
-        crps = xr.apply_ufunc(ps.crps_ensemble,
-                        dt_ds[f'obs_{predictand}'],
-                        dt_ds['pdf'].isel(pdf_parameter=0),
-                        dt_ds['pdf'].isel(pdf_parameter=1),
-                        exclude_dims=set(('pdf_index',)),
-                        input_core_dims=[[], ["pdf_index"], ["pdf_index"]],
-                        vectorize=True)
-        dt_ds['crps'] = crps.astype(np.float32)
-
-    # elif dt_kind=='DLITE':
-    # normal distribution (mean + sd)
-    elif dt_ds.attrs['pdf_type']==8:
-        # observation probabiltiy (for the normal dist)
-        p_obs = xr.apply_ufunc(norm.pdf,
-                        dt_ds[f'obs_{predictand}'],
-                        dt_ds[f'{predictand}_PDF_parameter'].isel(pdf_parameter=0),
-                        dt_ds[f'{predictand}_PDF_parameter'].isel(pdf_parameter=1),
-                        exclude_dims=set(('pdf_index',)),
-                        input_core_dims=[[], ["pdf_index"], ["pdf_index"]],
-                        vectorize=True)
-        dt_ds['p_obs'] = p_obs.astype(np.float32)
-
-        # negative log likelihood
-        dt_ds['negloglik'] = -np.log(dt_ds['p_obs'])
-
-        # cumulative proba (for PIT histogram)
-        cp_obs = xr.apply_ufunc(norm.cdf,
-                        dt_ds[f'obs_{predictand}'],
-                        dt_ds[f'{predictand}_PDF_parameter'].isel(pdf_parameter=0),
-                        dt_ds[f'{predictand}_PDF_parameter'].isel(pdf_parameter=1),
-                        exclude_dims=set(('pdf_index',)),
-                        input_core_dims=[[], ["pdf_index"], ["pdf_index"]],
-                        vectorize=True)
-        dt_ds['cp_obs'] = cp_obs.astype(np.float32)
-
-        # crps
-        crps = xr.apply_ufunc(ps.crps_gaussian,
-                        dt_ds[f'obs_{predictand}'],
-                        dt_ds[f'{predictand}_PDF_parameter'].isel(pdf_parameter=0),
-                        dt_ds[f'{predictand}_PDF_parameter'].isel(pdf_parameter=1),
-                        exclude_dims=set(('pdf_index',)),
-                        input_core_dims=[[], ["pdf_index"], ["pdf_index"]],
-                        vectorize=True)
-        dt_ds['crps'] = crps.astype(np.float32)
-
-    return dt_ds[['validtime', f'obs_{predictand}', 'mean', 'var', 'std', 'p_obs', 'cp_obs', 'negloglik', 'crps']]
+    metrics = METRICS if metrics is None else list(metrics)
+    dt_ds = score_dt(dt_ds, f'obs_{predictand}', predictand, metrics=metrics)
 
+    return dt_ds[['validtime', f'obs_{predictand}', 'mean', 'var', 'std'] + metrics]
 
 
 class VerifDT(VerifModelStation):
@@ -153,6 +279,16 @@ class VerifDT(VerifModelStation):
         dt_end (datetime.datetime): The end datetime.
         predictand (str): DeepThought predictand requested (ex 'TTTTT')
         dt_kind (str): either "ePD" or "DLITE"
+        basetime_chunks (int): opt-in lazy mode: number of basetimes per dask chunk
+                               (the scoring graph is built lazily and computed chunk by chunk)
+        dask_scheduler (str): local dask scheduler for the lazy mode ('threads', 'processes', 'synchronous')
+        obs_tolerance (str): match the nearest obs within the tolerance (ex '5min') instead of the exact valid time
+        float32 (bool): compute the gaussian scores in float32
+        metrics (list): metrics to compute (default p_obs, cp_obs, negloglik, crps, see SCORING_RULES)
+        basetime_block_days (int): streaming mode: the forecasts are fetched, scored and reduced by blocks
+                                   of basetime_block_days days of basetimes, which bounds the peak memory
+        basetime_hours (list): basetime hours to verify (ex [0, 12])
+        max_prognosis_period (int): number of prognosis periods to verify (ex 85 for a 85h max lead)
     """
     def __init__(self,
                  station_id,
@@ -163,7 +299,15 @@ class VerifDT(VerifModelStation):
                  model_vars,
                  fcast_window=16,
                  freq='hourly',
-                 api_key=None
+                 api_key=None,
+                 basetime_chunks=None,
+                 dask_scheduler='threads',
+                 obs_tolerance=None,
+                 float32=False,
+                 metrics=None,
+                 basetime_block_days=None,
+                 basetime_hours=None,
+                 max_prognosis_period=None
                  ):
         super().__init__(station_id,
                          dt_start,
@@ -174,114 +318,226 @@ class VerifDT(VerifModelStation):
                          fcast_window,
                          freq,
                          api_key)
-        # obs query
-        self.obs_ds = super().query_obs()
+        self.basetime_chunks = basetime_chunks
+        self.dask_scheduler = dask_scheduler
+        self.obs_tolerance = obs_tolerance
+        self.float32 = float32
+        self.metrics = METRICS if metrics is None else list(metrics)
+        self.basetime_block_days = basetime_block_days
+        self.basetime_hours = basetime_hours
+        self.max_prognosis_period = max_prognosis_period
+
+        # obs queried lazily (obs_ds), through the process-level obs store
 
         self.verif_ds_list = []
 
+    def basetime_blocks(self):
+        """ (start, end) basetime windows of basetime_block_days days covering dt_start - dt_end:
+            half-open [dt_start + i*block, dt_start + (i+1)*block), the last one closed at dt_end
+        """
+        if not self.basetime_block_days:
+            return [(self.dt_start, self.dt_end)]
+        block = datetime.timedelta(days=self.basetime_block_days)
+        n_blocks = (self.dt_end - self.dt_start) // block + 1
+        return [(self.dt_start + i * block, min(self.dt_start + (i + 1) * block, self.dt_end))
+                for i in range(n_blocks)]
+
+    def score_forecasts(self, model_var, dt_ds):
+        """ Align the obs on the forecasts of a model var, score them and reduce them to the output variables
+        """
+        # observation mapping on the 'validtime' variable
+        obs_predictand = align_obs(self.obs_ds.time.values,
+                                   self.obs_ds[f'{model_var}_obs'].values,
+                                   dt_ds['validtime'].values,
+                                   self.obs_tolerance).astype(np.float32)
+        # assign with the same dimensions
+        dt_ds[f'{model_var}_obs'] = (('basetime', 'prognosis_period'), obs_predictand)
+        # add metadata
+        dt_ds[f'{model_var}_obs'].attrs = self.obs_ds[f'{model_var}_obs'].attrs
+
+        # lazy mode: chunk along basetime, scores built as a dask graph
+        if self.basetime_chunks:
+            dt_ds = dt_ds.chunk({'basetime': self.basetime_chunks})
+
+        dt_ds = score_dt(dt_ds, f'{model_var}_obs', model_var, self.float32, self.metrics)
+
+        verif_ds = dt_ds[['validtime', f'{model_var}_obs', 'mean', 'var', 'std'] + self.metrics]
+        if self.basetime_chunks:
+            verif_ds = verif_ds.compute(scheduler=self.dask_scheduler)
+
+        return verif_ds
+
     def verify_vars(self):
         """ DeepThought Prob verification 
             Outputs a list of xr dataset for each requested model_var
+            With basetime_block_days, the forecasts are fetched, scored and reduced one basetime block
+            at a time (the pdf/cdf of a block are freed before the next one)
+            A block without forecasts is skipped, any other fetch error is raised (no partial output)
         """
 
         for model_var in self.model_vars:
-            # get deepthought forecast from the archive
-            try:
-                dt_ds = get_dt_output(self.station_id,
-                                    self.dt_start,
-                                    self.dt_end,
-                                    model_var,
-                                    source='S3',
-                                    dt_kind=self.model,
-                                    output=None)
-            except:
+            verif_blocks = []
+            blocks = self.basetime_blocks()
+            for i_block, (block_start, block_end) in enumerate(blocks):
+                # get deepthought forecast from the archive
+                try:
+                    dt_ds = fetch_dt_output(self.station_id,
+                                            block_start,
+                                            block_end,
+                                            model_var,
+                                            self.model)
+                except NoForecastData:
+                    # a block without forecasts is skipped, any other fetch error fails the model var
+                    print(f"No {self.model} data for station {self.station_id}/{model_var} "
+                          f"({block_start:%Y-%m-%d %H:%M} - {block_end:%Y-%m-%d %H:%M})")
+                    continue
+                # only the forecast cells to verify are aligned and scored
+                dt_ds = filter_forecasts(dt_ds, self.basetime_hours, self.max_prognosis_period)
+
+                # half-open blocks: a basetime on a block boundary belongs to the next block
+                if i_block < len(blocks) - 1:
+                    dt_ds = dt_ds.sel(basetime=dt_ds['basetime'] < np.datetime64(block_end))
+                if dt_ds.sizes['basetime'] == 0:
+                    continue
+
+                verif_blocks.append(self.score_forecasts(model_var, dt_ds).load())
+                del dt_ds
+
+            if not verif_blocks:
                 print(f"No {self.model} data for station {self.station_id}/{model_var}")
                 return
-    
-            # observation mapping
-            mapping = dict(zip(pd.to_datetime(self.obs_ds.time.values),
-                               self.obs_ds[f'{model_var}_obs'].values))
-            map_func = np.vectorize(lambda x: mapping.get(x, np.nan))
 
-            # apply the mapping function to the 'validtime' variable 
-            obs_predictand = map_func(pd.to_datetime(dt_ds['validtime'].values)).astype(np.float32)
+            if len(verif_blocks) == 1:
+                self.verif_ds_list.append(verif_blocks[0])
+            else:
+                self.verif_ds_list.append(xr.concat(verif_blocks, dim='basetime',
+                                                    data_vars='minimal', coords='minimal',
+                                                    combine_attrs='override'))
+        
+        return self.verif_ds_list
+
+
+class VerifDTStations(VerifModelStations):
+    """ Class for DT verification (ePD or DLITE) of a batch of stations:
+        the observations and forecasts of all the stations are fetched concurrently and stacked
+        along a `station` dimension, then scored in one vectorised call per model var.
+    Args:
+        station_ids (list): WMO station ids.
+        dt_start (datetime.datetime): The start datetime.
+        dt_end (datetime.datetime): The end datetime.
+        obs_source (str): obs data source ('DDB_obs', 'API_obs')
+        model (str): either "ePD" or "DLITE"
+        model_vars (list): DeepThought predictands requested (ex ['TTTTT'])
+        max_workers (int): max number of stations fetched concurrently
+        obs_tolerance (str): match the nearest obs within the tolerance (ex '5min') instead of the exact valid time
+        float32 (bool): compute the gaussian scores in float32
+        metrics (list): metrics to compute (default p_obs, cp_obs, negloglik, crps, see SCORING_RULES)
+        basetime_hours (list): basetime hours to verify (ex [0, 12])
+        max_prognosis_period (int): number of prognosis periods to verify (ex 85 for a 85h max lead)
+    """
+    def __init__(self,
+                 station_ids,
+                 dt_start,
+                 dt_end,
+                 obs_source,
+                 model,
+                 model_vars,
+                 fcast_window=16,
+                 freq='hourly',
+                 api_key=None,
+                 max_workers=8,
+                 obs_tolerance=None,
+                 float32=False,
+                 metrics=None,
+                 basetime_hours=None,
+                 max_prognosis_period=None
+                 ):
+        super().__init__(station_ids,
+                         dt_start,
+                         dt_end,
+                         obs_source,
+                         model,
+                         model_vars,
+                         fcast_window,
+                         freq,
+                         api_key,
+                         max_workers)
+        self.obs_tolerance = obs_tolerance
+        self.float32 = float32
+        self.metrics = METRICS if metrics is None else list(metrics)
+        self.basetime_hours = basetime_hours
+        self.max_prognosis_period = max_prognosis_period
+
+        # obs query
+        self.obs_ds = super().query_obs()
+
+        self.verif_ds = None
+
+    def get_forecasts(self, model_var):
+        """ DeepThought forecasts of all the stations for a model var, stacked along `station`
+            (stations without data are dropped, other fetch errors are raised)
+        """
+        def fetch_station(station_id):
+            try:
+                dt_ds = fetch_dt_output(station_id,
+                                        self.dt_start,
+                                        self.dt_end,
+                                        model_var,
+                                        self.model)
+            except NoForecastData:
+                # any other fetch error is raised (no silently smaller station dimension)
+                print(f"No {self.model} data for station {station_id}/{model_var}")
+                return
+            return filter_forecasts(dt_ds, self.basetime_hours, self.max_prognosis_period)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(self.station_ids)))) as executor:
+            station_dt = list(executor.map(fetch_station, self.station_ids))
+
+        fetched = [(station_id, dt_ds) for station_id, dt_ds in zip(self.station_ids, station_dt)
+                   if dt_ds is not None]
+        if not fetched:
+            return
+
+        return xr.concat([dt_ds.drop_vars('station', errors='ignore') for _, dt_ds in fetched],
+                         dim=pd.Index([station_id for station_id, _ in fetched], name='station'),
+                         join='outer',
+                         combine_attrs='override')
+
+    def verify_vars(self):
+        """ DeepThought Prob verification of all the stations
+            Outputs a single xr dataset (dims station/basetime/prognosis_period) with
+            {model_var}_obs, {model_var}_mean... {model_var}_crps for each requested model_var
+        """
+        if self.obs_ds is None:
+            return
+
+        verif_ds_list = []
+        for model_var in self.model_vars:
+            # get deepthought forecast from the archive
+            dt_ds = self.get_forecasts(model_var)
+            if dt_ds is None:
+                print(f"No {self.model} data for {model_var}")
+                continue
+
+            # observation mapping: obs of each station at its forecast valid times
+            obs_da = self.obs_ds[f'{model_var}_obs'].reindex(station=dt_ds['station'].values)
+            obs_predictand = align_obs(obs_da.time.values,
+                                       obs_da.transpose('station', 'time').values,
+                                       dt_ds['validtime'].transpose('station', ...).values,
+                                       self.obs_tolerance).astype(np.float32)
             # assign with the same dimensions
-            dt_ds[f'{model_var}_obs'] = (('basetime', 'prognosis_period'), obs_predictand)
+            dt_ds[f'{model_var}_obs'] = (dt_ds['validtime'].transpose('station', ...).dims, obs_predictand)
             # add metadata
             dt_ds[f'{model_var}_obs'].attrs = self.obs_ds[f'{model_var}_obs'].attrs
 
-            # if dt_kind=='ePD':
-            # full prob distribution
-            if dt_ds.attrs['pdf_type']==3:
-                # observation probabiltiy
-                p_obs = xr.apply_ufunc(np.interp,
-                                dt_ds[f'{model_var}_obs'],
-                                dt_ds['pdf'].isel(pdf_parameter=0),
-                                dt_ds['pdf'].isel(pdf_parameter=1),
-                                exclude_dims=set(('pdf_index',)),
-                                input_core_dims=[[], ["pdf_index"], ["pdf_index"]],
-                                vectorize=True)
-                dt_ds['p_obs'] = p_obs.astype(np.float32)
-
-                # negative log likelihood
-                dt_ds['negloglik'] = -np.log(dt_ds['p_obs'])
-
-                # cumulative proba (for PIT histogram)
-                cp_obs = xr.apply_ufunc(np.interp,
-                                dt_ds[f'{model_var}_obs'],
-                                dt_ds['cdf'].isel(pdf_parameter=0),
-                                dt_ds['cdf'].isel(pdf_parameter=1),
-                                exclude_dims=set(('pdf_index',)),
-                                input_core_dims=[[], ["pdf_index"], ["pdf_index"]],
-                                vectorize=True)
-                dt_ds['cp_obs'] = cp_obs.astype(np.float32)
-
-                # crps
-                crps = xr.apply_ufunc(ps.crps_ensemble,
-                                dt_ds[f'{model_var}_obs'],
-                                dt_ds['pdf'].isel(pdf_parameter=0),
-                                dt_ds['pdf'].isel(pdf_parameter=1),
-                                exclude_dims=set(('pdf_index',)),
-                                input_core_dims=[[], ["pdf_index"], ["pdf_index"]],
-                                vectorize=True)
-                dt_ds['crps'] = crps.astype(np.float32)
-
-            # elif dt_kind=='DLITE':
-            # normal distribution (mean + sd)
-            elif dt_ds.attrs['pdf_type'] in [0,8]:
-                # observation probabiltiy (for the normal dist)
-                p_obs = xr.apply_ufunc(norm.pdf,
-                                dt_ds[f'{model_var}_obs'],
-                                dt_ds[f'{model_var}_PDF_parameter'].isel(pdf_parameter=0),
-                                dt_ds[f'{model_var}_PDF_parameter'].isel(pdf_parameter=1),
-                                exclude_dims=set(('pdf_index',)),
-                                input_core_dims=[[], ["pdf_index"], ["pdf_index"]],
-                                vectorize=True)
-                dt_ds['p_obs'] = p_obs.astype(np.float32)
-
-                # negative log likelihood
-                dt_ds['negloglik'] = -np.log(dt_ds['p_obs'])
-
-                # cumulative proba (for PIT histogram)
-                cp_obs = xr.apply_ufunc(norm.cdf,
-                                dt_ds[f'{model_var}_obs'],
-                                dt_ds[f'{model_var}_PDF_parameter'].isel(pdf_parameter=0),
-                                dt_ds[f'{model_var}_PDF_parameter'].isel(pdf_parameter=1),
-                                exclude_dims=set(('pdf_index',)),
-                                input_core_dims=[[], ["pdf_index"], ["pdf_index"]],
-                                vectorize=True)
-                dt_ds['cp_obs'] = cp_obs.astype(np.float32)
-
-                # crps
-                crps = xr.apply_ufunc(ps.crps_gaussian,
-                                dt_ds[f'{model_var}_obs'],
-                                dt_ds[f'{model_var}_PDF_parameter'].isel(pdf_parameter=0),
-                                dt_ds[f'{model_var}_PDF_parameter'].isel(pdf_parameter=1),
-                                exclude_dims=set(('pdf_index',)),
-                                input_core_dims=[[], ["pdf_index"], ["pdf_index"]],
-                                vectorize=True)
-                dt_ds['crps'] = crps.astype(np.float32)
-
-            self.verif_ds_list.append(dt_ds[['validtime', f'{model_var}_obs', 'mean', 'var', 'std', 'p_obs', 'cp_obs', 'negloglik', 'crps']])
-        
-        return self.verif_ds_list
\ No newline at end of file
+            dt_ds = score_dt(dt_ds, f'{model_var}_obs', model_var, self.float32, self.metrics)
+
+            verif_ds_list.append(
+                dt_ds[['validtime', f'{model_var}_obs', 'mean', 'var', 'std'] + self.metrics]
+                .rename({name: f'{model_var}_{name}' for name in ['mean', 'var', 'std'] + self.metrics}))
+
+        if not verif_ds_list:
+            return
+
+        self.verif_ds = xr.merge(verif_ds_list, join='outer', compat='no_conflicts', combine_attrs='override')
+        return self.verif_ds
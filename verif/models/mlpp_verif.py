@@ -4,12 +4,12 @@ MLPP verification class
 """
 import datetime
 import numpy as np
-from scipy.stats import norm
 import pandas as pd
 import xarray as xr
-import properscoring as ps
 
 from verif.models.verif import VerifModelStation
+from verif.models.align import align_obs
+from verif.models.scores import gaussian_scores
 
 
 class VerifMLPP(VerifModelStation):
@@ -24,6 +24,8 @@ class VerifMLPP(VerifModelStation):
         preds_ds (pd.DataFrame) : dataframe with predictions and forecast time
         freq (str): frequency requested (None: all points, 'hourly', '10min' )
         api_key (str): 1 min obs API key
+        obs_tolerance (str): match the nearest obs within the tolerance (ex '5min') instead of the exact forecast time
+        float32 (bool): compute the gaussian scores in float32
 
     Methods:
         verify_vars(self):
@@ -38,10 +40,14 @@ class VerifMLPP(VerifModelStation):
                  preds_ds,
                  fcast_window=0,
                  freq='hourly',
-                 api_key=None
+                 api_key=None,
+                 obs_tolerance=None,
+                 float32=False
                  ):
            
         self.preds_ds = preds_ds
+        self.obs_tolerance = obs_tolerance
+        self.float32 = float32
         dt_start = preds_ds['forecast_time'].min()
         dt_end = preds_ds['forecast_time'].max()
 
@@ -55,16 +61,22 @@ class VerifMLPP(VerifModelStation):
                          freq,
                          api_key)
         
-        # obs query for all related model variables
-        self.obs_ds = super().query_obs()
+        # obs for all related model variables queried lazily (obs_ds), through the process-level obs store
 
         self.verif_ds = None
 
     def verify_vars(self):
 
-        # join with obs
-        self.verif_ds = (self.preds_ds.set_index('forecast_time')
-                        .join(self.obs_ds.to_dataframe().tz_localize(tz='UTC')))
+        # obs aligned on the forecast times (UTC)
+        self.verif_ds = self.preds_ds.set_index('forecast_time')
+        forecast_time = pd.DatetimeIndex(self.verif_ds.index)
+        if forecast_time.tz is not None:
+            forecast_time = forecast_time.tz_convert('UTC').tz_localize(None)
+        for obs_name in self.obs_ds.data_vars:
+            self.verif_ds[obs_name] = align_obs(self.obs_ds.time.values,
+                                                self.obs_ds[obs_name].values,
+                                                forecast_time.values,
+                                                self.obs_tolerance)
         
         # verification metrics for each var to verify (Gaussian pdf only for now)
         for var in self.model_vars:
@@ -72,9 +84,14 @@ class VerifMLPP(VerifModelStation):
             self.verif_ds[f'{var}_error'] = self.verif_ds[f'p1_{var}'] - self.verif_ds[f'{var}_obs']
             self.verif_ds[f'{var}_abs_error'] = np.abs(self.verif_ds[f'{var}_error'])
             self.verif_ds[f'{var}_error2'] = self.verif_ds[f'{var}_error']**2
-            self.verif_ds[f'{var}_p_obs'] = norm.pdf(self.verif_ds[f'{var}_obs'], self.verif_ds[f'p1_{var}'], self.verif_ds[f'p2_{var}'])
-            self.verif_ds[f'{var}_cp_obs'] = norm.cdf(self.verif_ds[f'{var}_obs'], self.verif_ds[f'p1_{var}'], self.verif_ds[f'p2_{var}'])
-            self.verif_ds[f'{var}_negloglik'] = -np.log(self.verif_ds[f'{var}_p_obs'])
-            self.verif_ds[f'{var}_crps'] = ps.crps_gaussian(self.verif_ds[f'{var}_obs'], self.verif_ds[f'p1_{var}'], self.verif_ds[f'p2_{var}'])
+            # pdf, cdf, log likelihood and crps in one pass (fused gaussian kernel)
+            p_obs, cp_obs, loglik, crps = gaussian_scores(self.verif_ds[f'{var}_obs'].values,
+                                                          self.verif_ds[f'p1_{var}'].values,
+                                                          self.verif_ds[f'p2_{var}'].values,
+                                                          np.float32 if self.float32 else np.float64)
+            self.verif_ds[f'{var}_p_obs'] = p_obs
+            self.verif_ds[f'{var}_cp_obs'] = cp_obs
+            self.verif_ds[f'{var}_negloglik'] = -loglik
+            self.verif_ds[f'{var}_crps'] = crps
                         
         return self.verif_ds
\ No newline at end of file
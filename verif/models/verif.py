@@ -1,9 +1,12 @@
 """
-Verification parent class
+Verification parent classes (one station / a batch of stations)
 """
 import datetime
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
 import xarray as xr
 from verif.obs import ddb, utils, obsAPI
+from verif.obs.store import obs_store
 
 
 class VerifModelStation():
@@ -19,6 +22,9 @@ class VerifModelStation():
         model_vars (list): list of model variables we want to verify
         freq (str): frequency requested (None: all points, 'hourly', '10min' )  
         api_key (str): 1 min obs API key
+
+    The obs are queried lazily, on the first access to obs_ds, through the process-level obs store
+    (verif.obs.store): the verifications of several models at the same station share the obs series.
     """
 
     def __init__(self,
@@ -41,72 +47,173 @@ class VerifModelStation():
         self.fcast_window = fcast_window
         self.freq = freq
         self.api_key = api_key
-        self.obs_ds = None
+        self._obs_ds = None
+        self._obs_queried = False
 
+    @property
+    def obs_ds(self):
+        """ Obs dataset ({model_var}_obs variables), queried on first access (None if no obs)
+        """
+        if not self._obs_queried:
+            self._obs_queried = True
+            self._obs_ds = self.query_obs()
+        return self._obs_ds
+
+    @obs_ds.setter
+    def obs_ds(self, obs_ds):
+        self._obs_ds = obs_ds
+        self._obs_queried = True
+
+    def fetch_obs(self, obs_var_names, obs_dt_end):
+        """ Query the obs source for obs vars (obs units), dt_start - obs_dt_end
+        Returns:
+            Dataset: xarray Dataset with one variable per obs var, dim time (None if not available)
+        """
+        if self.obs_source=='DDB_obs':
+            try:
+                obs_id = utils.catalogue.obs_id(self.station_id)
+            except KeyError:
+                print('Station not in iceobs_stations for DDB! Please use another obs source')
+                return
+            obs_all = ddb.get_obs_all(f'{obs_id}_nzaws', self.dt_start, obs_dt_end, table_recent = True)
+            # all obs vars extracted in a single pass
+            return ddb.extract_obs_dataset(obs_all, obs_var_names, self.freq)
+
+        elif self.obs_source=='API_obs':
+            obs_api = obsAPI.RequestAPI(station_id=self.station_id, apikey=self.api_key)
+            obs_api.query_range(self.dt_start, obs_dt_end)
+            # all obs vars extracted in a single pass
+            return obs_api.extract_obs_dataset(obs_var_names, self.freq)
 
     def query_obs(self):
         """ Query the obs source - all data points
+            (through the obs store: only the obs series not already fetched in the process are queried)
         Args:
             obs_source (str): obs data source ('DDB', 'API')
             model_vars (list): list of model vararibles we want to verify
         """
-        obs_vars = utils.load_obs_vars()
+        # get the obs var to retrieve for each model var
+        obs_var_map = {}
+        for model_var in self.model_vars:
+            try:
+                obs_var_map[model_var] = utils.catalogue.obs_var(self.model, model_var, self.obs_source)
+            except KeyError:
+                print(f'{model_var}/{self.model}/{self.obs_source} not in the obs_var list!')
+                return
+        obs_var_names = list(dict.fromkeys(obs_var.name for obs_var in obs_var_map.values()))
+        obs_dt_end = self.dt_end + datetime.timedelta(days=self.fcast_window)
 
-        self.obs_ds = xr.Dataset()
+        if self.obs_source not in ['DDB_obs', 'API_obs']:
+            self.obs_ds = xr.Dataset()
+            return self.obs_ds
 
-        if self.obs_source=='DDB_obs':
+        obs_var_ds = obs_store.get(self.station_id, self.obs_source, obs_var_names,
+                                   self.dt_start, obs_dt_end, self.freq,
+                                   lambda var_names: self.fetch_obs(var_names, obs_dt_end))
+        if obs_var_ds is None:
+            return
+
+        obs_ds = xr.Dataset()
+        for model_var, obs_var in obs_var_map.items():
+            # convert to the model unit
+            obs_var_serie = obs_var_ds[obs_var.name] * obs_var.conv[0] + obs_var.conv[1]
+            # add metedata
+            obs_var_serie.attrs['observation source'] = f'{self.obs_source} - converted units'
+            obs_var_serie.attrs['observation var'] = obs_var.name
+            obs_var_serie.attrs['unit'] = obs_var.unit
+
+            obs_ds[f'{model_var}_obs'] = obs_var_serie
+
+        self.obs_ds = obs_ds
+        return self.obs_ds
+
+class VerifModelStations():
+    """ Generic Class for Model verification for a list of stations against an observation source.
+        Batch counterpart of VerifModelStation: the observations of all the stations are fetched
+        concurrently and stacked along a `station` dimension.
+
+    Args:
+        station_ids (list): WMO station ids.
+        dt_start (datetime.datetime): The start model basetime
+        dt_end (datetime.datetime): The end model basetime
+        fcast_window (int): number of days to include in the obs windows after dt_end
+        obs_source (str): obs data source ('DDB_obs', 'API_obs')
+        model (str): model to verify (need to be referenced in the Yaml)
+        model_vars (list): list of model variables we want to verify
+        freq (str): frequency requested (None: all points, 'hourly', '10min' )
+        api_key (str): 1 min obs API key
+        max_workers (int): max number of stations fetched concurrently
+    """
+
+    def __init__(self,
+                 station_ids,
+                 dt_start,
+                 dt_end,
+                 obs_source,
+                 model,
+                 model_vars,
+                 fcast_window=0,
+                 freq=None,
+                 api_key=None,
+                 max_workers=8
+                 ):
+        self.station_ids = list(station_ids)
+        self.dt_start = dt_start
+        self.dt_end = dt_end
+        self.obs_source = obs_source
+        self.model = model
+        self.model_vars = model_vars
+        self.fcast_window = fcast_window
+        self.freq = freq
+        self.api_key = api_key
+        self.max_workers = max_workers
+        self.obs_ds = None
+
+    def query_obs(self):
+        """ Query the obs source for all the stations
+            Returns a dataset with a {model_var}_obs variable per model var, dims station/time
+        """
+        # get the obs var to retrieve for each model var
+        obs_var_map = {}
+        for model_var in self.model_vars:
             try:
-                obs_id = utils.get_obs_id(self.station_id)
+                obs_var_map[model_var] = utils.catalogue.obs_var(self.model, model_var, self.obs_source)
             except KeyError:
-                print('Station not in iceobs_stations for DDB! Please use another obs source')
+                print(f'{model_var}/{self.model}/{self.obs_source} not in the obs_var list!')
                 return
-            obs_all = ddb.get_obs_all(f'{obs_id}_nzaws',
-                                      self.dt_start,
-                                      self.dt_end + datetime.timedelta(days=self.fcast_window),
-                                      table_recent = True)
-            for model_var in self.model_vars:
-                # get the obs var to retrieve
-                try:
-                    obs_var = list(obs_vars[self.model][model_var][self.obs_source].keys())[0]
-                except KeyError:
-                    print(f'{model_var}/{self.model}/{self.obs_source} not in the obs_var list!')
-                    return
-                obs_var_serie = ddb.extract_obs_data(obs_all, obs_var, self.freq)
-
-                # convert to the model unit
-                obs_var_serie = (obs_var_serie * obs_vars[self.model][model_var][self.obs_source][obs_var]['conv'][0]
-                                + obs_vars[self.model][model_var][self.obs_source][obs_var]['conv'][1]
-                                )
-                # add metedata
-                obs_var_serie.attrs['observation source'] = f'{self.obs_source} - converted units'
-                obs_var_serie.attrs['observation var'] = obs_var
-                obs_var_serie.attrs['unit'] = obs_vars[self.model][model_var]['unit']
-
-                self.obs_ds[f'{model_var}_obs'] = obs_var_serie
+        obs_var_names = list(dict.fromkeys(obs_var.name for obs_var in obs_var_map.values()))
+        obs_dt_end = self.dt_end + datetime.timedelta(days=self.fcast_window)
+
+        if self.obs_source=='DDB_obs':
+            obs_var_ds = ddb.get_obs_stations(self.station_ids, obs_var_names, self.dt_start, obs_dt_end,
+                                              freq=self.freq, table_recent=True, max_workers=self.max_workers)
 
         elif self.obs_source=='API_obs':
-            obs_api = obsAPI.RequestAPI(station_id=self.station_id, apikey=self.api_key)
-            obs_all = obs_api.query_range(self.dt_start,
-                                          self.dt_end + datetime.timedelta(days=self.fcast_window))
-        
-            for model_var in self.model_vars:
-                # get the obs var to retrieve
-                try:
-                    obs_var = list(obs_vars[self.model][model_var][self.obs_source].keys())[0]
-                except KeyError:
-                    print(f'{model_var}/{self.model}/{self.obs_source} not in the obs_var list!')
-                    return
-                obs_var_serie = obs_api.extract_obs_data(obs_var, self.freq)
-
-                # convert to the model unit
-                obs_var_serie = (obs_var_serie * obs_vars[self.model][model_var][self.obs_source][obs_var]['conv'][0]
-                                + obs_vars[self.model][model_var][self.obs_source][obs_var]['conv'][1]
-                                )
-                # add metedata
-                obs_var_serie.attrs['observation source'] = f'{self.obs_source} - converted units'
-                obs_var_serie.attrs['observation var'] = obs_var
-                obs_var_serie.attrs['unit'] = obs_vars[self.model][model_var]['unit']
-
-                self.obs_ds[f'{model_var}_obs'] = obs_var_serie
-
-        return self.obs_ds
\ No newline at end of file
+            def fetch_station(station_id):
+                obs_api = obsAPI.RequestAPI(station_id=station_id, apikey=self.api_key, max_workers=1)
+                obs_api.query_range(self.dt_start, obs_dt_end)
+                return obs_api.extract_obs_dataset(obs_var_names, self.freq)
+
+            with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(self.station_ids)))) as executor:
+                station_ds = list(executor.map(fetch_station, self.station_ids))
+            obs_var_ds = xr.concat(station_ds,
+                                   dim=pd.Index(self.station_ids, name='station'),
+                                   join='outer')
+        else:
+            obs_var_ds = None
+
+        if obs_var_ds is None:
+            return
+
+        self.obs_ds = xr.Dataset()
+        for model_var, obs_var in obs_var_map.items():
+            # convert to the model unit
+            obs_var_serie = obs_var_ds[obs_var.name] * obs_var.conv[0] + obs_var.conv[1]
+            # add metedata
+            obs_var_serie.attrs['observation source'] = f'{self.obs_source} - converted units'
+            obs_var_serie.attrs['observation var'] = obs_var.name
+            obs_var_serie.attrs['unit'] = obs_var.unit
+
+            self.obs_ds[f'{model_var}_obs'] = obs_var_serie
+
+        return self.obs_ds
@@ -1,5 +1,8 @@
 import boto3
-from os import environ
+import pandas as pd
+import threading
+from botocore.config import Config
+from os import environ, getpid
 
 
 # environment variables
@@ -14,4 +17,57 @@ resource_ddb = session.resource("dynamodb", region_name="us-west-2")
 
 # AWS settings
 TABLE_NAME = "prod_observations_archive_{year}"
-TABLE_NAME_recent = "prod_observations_recent"
\ No newline at end of file
+TABLE_NAME_recent = "prod_observations_recent"
+REGION_NAME = "us-west-2"
+# retention of the recent table in days (older valid times are only in the archive tables)
+DDB_RECENT_DAYS = int(environ.get("DDB_RECENT_DAYS", 30))
+
+# DDB query planner settings (concurrent sub-range queries)
+DDB_MAX_WORKERS = int(environ.get("DDB_MAX_WORKERS", 8))
+DDB_SPLIT_DAYS = int(environ.get("DDB_SPLIT_DAYS", 31))
+DDB_RETRY_CONFIG = Config(retries={"max_attempts": 10, "mode": "adaptive"},
+                          max_pool_connections=max(10, DDB_MAX_WORKERS))
+
+# 1 min obs API obs_timestamp format ('2023-01-01T00:00:00Z', parsed as UTC)
+API_TIME_FORMAT = "ISO8601"
+
+# 1 min obs API settings (concurrent day requests)
+API_MAX_WORKERS = int(environ.get("API_MAX_WORKERS", 8))
+API_MAX_RETRIES = int(environ.get("API_MAX_RETRIES", 5))
+API_BACKOFF_FACTOR = float(environ.get("API_BACKOFF_FACTOR", 0.5))
+
+# local obs cache settings (no cache if OBS_CACHE_DIR is not set)
+OBS_CACHE_DIR = environ.get("OBS_CACHE_DIR", None)
+OBS_CACHE_RECENT_DAYS = int(environ.get("OBS_CACHE_RECENT_DAYS", 30))
+OBS_CACHE_TTL_MINS = int(environ.get("OBS_CACHE_TTL_MINS", 60))
+
+# in-memory obs store settings (obs series shared by the verifications of a process)
+OBS_STORE_MAX_MB = float(environ.get("OBS_STORE_MAX_MB", 1024))
+
+# one low-level DynamoDB client per process: clients are thread safe, so all the query threads
+# share its connection pool and its adaptive retry rate limiter (throttling feedback)
+_client_lock = threading.Lock()
+_client_ddb = (None, None)
+
+
+def get_client_ddb():
+    """ Get the low-level DynamoDB client of the process (shared by the query threads)
+    """
+    global _client_ddb
+    with _client_lock:
+        # not inherited by forked worker processes
+        if _client_ddb[0] != getpid():
+            process_session = boto3.session.Session(profile_name=AWS_PROFILE)
+            _client_ddb = (getpid(), process_session.client("dynamodb",
+                                                            region_name=REGION_NAME,
+                                                            config=DDB_RETRY_CONFIG))
+        return _client_ddb[1]
+
+
+def to_naive_utc(dt):
+    """ Convert a datetime/Timestamp (naive UTC or tz-aware) to a naive UTC datetime
+    """
+    dt = pd.Timestamp(dt)
+    if dt.tzinfo is not None:
+        dt = dt.tz_convert("UTC").tz_localize(None)
+    return dt.to_pydatetime()
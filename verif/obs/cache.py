@@ -0,0 +1,330 @@
+"""
+Local on-disk cache for the observations queried from DynamoDB or the 1 min API.
+
+Observations are stored as Parquet partitions {root}/{source}/{obs_id}/{year}/{month}.parquet
+(or {year}/{month}/{day}.parquet for daily partitions), one row per record (its time key and the
+JSON-encoded record, so the records are returned with their original value types), and the time ranges already fetched are
+recorded in {root}/{source}/{obs_id}/coverage.json, so only the missing gaps of a requested range
+are queried. The gaps -> fetch -> store sequence of an obs_id holds a file lock
+({root}/{source}/{obs_id}/.lock), so concurrent fetches of a station (threads or processes) are
+serialised and the coverage is never lost.
+Ranges made of UTC days which were older than the recent retention when fetched never expire,
+more recent ranges are refetched once their TTL has elapsed. With no retention and no TTL
+(1 min API), fully elapsed days are cached permanently and the current day is always refetched.
+"""
+
+import contextlib
+import datetime
+import decimal
+import fcntl
+import json
+import os
+import threading
+
+import pandas as pd
+
+from . import to_naive_utc, API_TIME_FORMAT, OBS_CACHE_DIR, OBS_CACHE_RECENT_DAYS, OBS_CACHE_TTL_MINS
+from .. import get_loggers
+
+
+logger = get_loggers()
+
+ONE_SECOND = datetime.timedelta(seconds=1)
+
+
+def _utcnow():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None, microsecond=0)
+
+
+def _tmp_path(path):
+    """ Temporary file name owned by the calling process/thread
+    """
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def _encode_value(value):
+    """ JSON encoding of the non JSON types of the records (DynamoDB Decimal numbers and sets)
+    """
+    if isinstance(value, decimal.Decimal):
+        return {"__decimal__": str(value)}
+    if isinstance(value, (set, frozenset)):
+        return {"__set__": list(value)}
+    raise TypeError(f"Obs cache: cannot encode {type(value).__name__} value {value!r}")
+
+
+def _decode_value(obj):
+    if len(obj) == 1 and "__decimal__" in obj:
+        return decimal.Decimal(obj["__decimal__"])
+    if len(obj) == 1 and "__set__" in obj:
+        return set(obj["__set__"])
+    return obj
+
+
+def encode_record(record: dict):
+    """ JSON string of a record, keeping the value types (see decode_record)
+    """
+    return json.dumps(record, default=_encode_value)
+
+
+def decode_record(record_json: str):
+    """ Record from encode_record, with its original value types
+    """
+    return json.loads(record_json, object_hook=_decode_value)
+
+
+def _to_key_time(dt):
+    """ Naive UTC datetime at the second resolution of the observation time keys
+    """
+    return to_naive_utc(dt).replace(microsecond=0)
+
+
+class ObsCache:
+    """Partitioned Parquet cache of observation records with gap-only refill.
+
+    Args:
+        root (str): cache root directory.
+        source (str): obs data source namespace (ex 'DDB_obs', 'API_obs').
+        time_key (str): record attribute holding the observation time.
+        time_format (str): strptime format of time_key (or 'ISO8601').
+        recent_days (int): retention of the recent (still changing) observations in days.
+        ttl_mins (int): time to live of the cached recent observations in minutes.
+        partition (str): partition granularity ('month' or 'day').
+
+    Attributes:
+        hits (int): number of (obs_id, UTC day) requested and fully served from the cache.
+        misses (int): number of (obs_id, UTC day) requested and (partly) fetched.
+
+    Methods:
+        get(obs_id, dt_start, dt_end, fetch): cached records, fetching the missing gaps.
+        gaps(obs_id, dt_start, dt_end): time ranges not covered by the cache.
+        store(obs_id, records, dt_start, dt_end): add fetched records for a time range.
+        load(obs_id, dt_start, dt_end): records in cache for a time range.
+        locked(obs_id): context manager holding the (inter-process) lock of an obs_id.
+    """
+
+    def __init__(self, root: str, source: str, time_key: str, time_format: str,
+                 recent_days: int = OBS_CACHE_RECENT_DAYS, ttl_mins: int = OBS_CACHE_TTL_MINS,
+                 partition: str = "month"):
+        self.root = os.path.join(root, source)
+        self.time_key = time_key
+        self.time_format = time_format
+        self.recent = datetime.timedelta(days=recent_days)
+        self.ttl = datetime.timedelta(minutes=ttl_mins)
+        self.partition = partition
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _parse_times(self, time_keys):
+        """ Naive UTC times of a column of time keys (tz-aware keys converted to UTC)
+        """
+        return pd.to_datetime(time_keys, format=self.time_format, utc=True).dt.tz_localize(None)
+
+    def _station_dir(self, obs_id):
+        return os.path.join(self.root, str(obs_id))
+
+    def _partition_keys(self, times):
+        if self.partition == "day":
+            return [times.dt.year, times.dt.month, times.dt.day]
+        return [times.dt.year, times.dt.month]
+
+    def _partition_path(self, obs_id, key):
+        if self.partition == "day":
+            year, month, day = key
+            return os.path.join(self._station_dir(obs_id), f"{year:04d}", f"{month:02d}", f"{day:02d}.parquet")
+        year, month = key
+        return os.path.join(self._station_dir(obs_id), f"{year:04d}", f"{month:02d}.parquet")
+
+    def _partition_range(self, dt_start, dt_end):
+        if self.partition == "day":
+            return [(day.year, day.month, day.day) for day in pd.period_range(dt_start, dt_end, freq="D")]
+        return [(month.year, month.month) for month in pd.period_range(dt_start, dt_end, freq="M")]
+
+    def _coverage_path(self, obs_id):
+        return os.path.join(self._station_dir(obs_id), "coverage.json")
+
+    def _read_coverage(self, obs_id):
+        try:
+            with open(self._coverage_path(obs_id), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+
+    def _write_coverage(self, obs_id, coverage):
+        path = self._coverage_path(obs_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = _tmp_path(path)
+        with open(tmp_path, "w") as f:
+            json.dump(coverage, f)
+        os.replace(tmp_path, path)
+
+    @contextlib.contextmanager
+    def locked(self, obs_id):
+        """ Exclusive lock of an obs_id cache directory (across threads and processes)
+        """
+        station_dir = self._station_dir(obs_id)
+        os.makedirs(station_dir, exist_ok=True)
+        with open(os.path.join(station_dir, ".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _immutable_end(self, fetched):
+        """ End of the UTC days older than the recent retention at fetch time
+        """
+        day_start = (fetched - self.recent).replace(hour=0, minute=0, second=0)
+        return day_start - ONE_SECOND
+
+    def _is_valid(self, interval, now):
+        """ A covered range is valid forever if its days were already older than the recent
+            retention when fetched, otherwise until its TTL has elapsed
+        """
+        end = datetime.datetime.fromisoformat(interval["end"])
+        fetched = datetime.datetime.fromisoformat(interval["fetched"])
+        return end <= self._immutable_end(fetched) or now - fetched < self.ttl
+
+    def gaps(self, obs_id, dt_start: datetime.datetime, dt_end: datetime.datetime):
+        """ Time ranges of [dt_start, dt_end] not covered by the cache
+        Returns:
+            list: list of (start, end) datetimes (inclusive)
+        """
+        dt_start = _to_key_time(dt_start)
+        dt_end = _to_key_time(dt_end)
+        now = _utcnow()
+
+        covered = sorted((datetime.datetime.fromisoformat(interval["start"]),
+                          datetime.datetime.fromisoformat(interval["end"]))
+                         for interval in self._read_coverage(obs_id) if self._is_valid(interval, now))
+        gaps = []
+        current = dt_start
+        for start, end in covered:
+            if end < current:
+                continue
+            if start > dt_end:
+                break
+            if start > current:
+                gaps.append((current, start - ONE_SECOND))
+            current = end + ONE_SECOND
+        if current <= dt_end:
+            gaps.append((current, dt_end))
+
+        return gaps
+
+    def store(self, obs_id, records: list, dt_start: datetime.datetime, dt_end: datetime.datetime):
+        """ Add the records fetched for [dt_start, dt_end] to the cache
+            (to be called with the obs_id lock held, see locked)
+        """
+        dt_start = _to_key_time(dt_start)
+        dt_end = _to_key_time(dt_end)
+        now = _utcnow()
+
+        if records:
+            # records kept whole (value types, null attributes), indexed by their time key
+            new_df = pd.DataFrame({self.time_key: [str(record[self.time_key]) for record in records],
+                                   "record": [encode_record(record) for record in records]})
+            # within a fetch the first record of a time wins (archive before recent table, as uncached)
+            new_df = new_df.drop_duplicates(subset=self.time_key, keep="first").reset_index(drop=True)
+            times = self._parse_times(new_df[self.time_key])
+
+            for key, part_df in new_df.groupby(self._partition_keys(times)):
+                path = self._partition_path(obs_id, key)
+                if os.path.exists(path):
+                    part_df = pd.concat([pd.read_parquet(path), part_df], ignore_index=True)
+                # fetched records override the older cached ones
+                part_df = part_df.drop_duplicates(subset=self.time_key, keep="last")
+                part_df = part_df.iloc[self._parse_times(part_df[self.time_key]).argsort(kind="stable")]
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = _tmp_path(path)
+                part_df.to_parquet(tmp_path, index=False)
+                os.replace(tmp_path, path)
+
+        # the part older than the recent retention never expires
+        coverage = [interval for interval in self._read_coverage(obs_id) if self._is_valid(interval, now)]
+        immutable_end = self._immutable_end(now)
+        if dt_start <= immutable_end < dt_end:
+            intervals = [(dt_start, immutable_end), (immutable_end + ONE_SECOND, dt_end)]
+        else:
+            intervals = [(dt_start, dt_end)]
+        coverage.extend({"start": start.isoformat(), "end": end.isoformat(), "fetched": now.isoformat()}
+                        for start, end in intervals)
+        self._write_coverage(obs_id, coverage)
+
+    def load(self, obs_id, dt_start: datetime.datetime, dt_end: datetime.datetime):
+        """ Records in cache for [dt_start, dt_end], in time order
+        Returns:
+            list: A list of dictionaries containing the observations.
+        """
+        dt_start = _to_key_time(dt_start)
+        dt_end = _to_key_time(dt_end)
+
+        records = []
+        for key in self._partition_range(dt_start, dt_end):
+            path = self._partition_path(obs_id, key)
+            if not os.path.exists(path):
+                continue
+            part_df = pd.read_parquet(path)
+            times = self._parse_times(part_df[self.time_key])
+            part_df = part_df[(times >= dt_start) & (times <= dt_end)]
+            records.extend(decode_record(record_json) for record_json in part_df["record"])
+
+        return records
+
+    def get(self, obs_id, dt_start: datetime.datetime, dt_end: datetime.datetime, fetch):
+        """ Records for [dt_start, dt_end], querying only the gaps not in cache
+        Args:
+            obs_id (str): station key
+            dt_start (datetime.datetime): The start datetime.
+            dt_end (datetime.datetime): The end datetime.
+            fetch (callable): fetch(start, end) returning the list of records for a gap
+        Returns:
+            list: A list of dictionaries containing the observations.
+        """
+        with self.locked(obs_id):
+            gaps = self.gaps(obs_id, dt_start, dt_end)
+
+            # hit/miss counters per requested UTC day
+            requested_days = set(pd.period_range(to_naive_utc(dt_start), to_naive_utc(dt_end), freq="D"))
+            missed_days = set()
+            for gap_start, gap_end in gaps:
+                missed_days.update(pd.period_range(gap_start, gap_end, freq="D"))
+            with self._lock:
+                self.misses += len(missed_days)
+                self.hits += len(requested_days - missed_days)
+
+            for gap_start, gap_end in gaps:
+                logger.debug(f"Obs cache miss {obs_id}: {gap_start} - {gap_end}")
+                self.store(obs_id, fetch(gap_start, gap_end), gap_start, gap_end)
+
+        return self.load(obs_id, dt_start, dt_end)
+
+    def stats(self):
+        """ Hit/miss counters (per requested obs_id/UTC day)
+        """
+        return {"hits": self.hits, "misses": self.misses}
+
+
+# process-wide caches (shared hit/miss counters)
+_caches = {}
+
+# cache settings of the obs data sources
+CACHE_SOURCES = {
+    # archive/recent DDB tables: monthly partitions, recent window with a TTL
+    "DDB_obs": dict(time_key="valid_time", time_format="%Y%m%d%H%M%S"),
+    "DDB_obs_archive": dict(time_key="valid_time", time_format="%Y%m%d%H%M%S"),
+    # 1 min API: daily partitions, elapsed days never change, the current day is always refetched
+    "API_obs": dict(time_key="obs_timestamp", time_format=API_TIME_FORMAT,
+                    recent_days=0, ttl_mins=0, partition="day"),
+}
+
+
+def get_cache(source: str):
+    """ Cache for an obs data source ('DDB_obs', 'DDB_obs_archive', 'API_obs'),
+        None if no cache dir is set (env OBS_CACHE_DIR)
+    """
+    if not OBS_CACHE_DIR:
+        return None
+    if source not in _caches:
+        _caches[source] = ObsCache(OBS_CACHE_DIR, source, **CACHE_SOURCES[source])
+    return _caches[source]
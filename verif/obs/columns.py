@@ -0,0 +1,110 @@
+"""
+Columnar (NumPy) helpers to decode observation records and build xarray datasets
+"""
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+def to_float_column(values: list):
+    """ Convert a list of raw values (Decimal, str, number, None) to a float64 array (NaN if not numeric)
+    """
+    return pd.to_numeric(pd.Series(values, dtype=object), errors="coerce").to_numpy(dtype=np.float64)
+
+
+def records_to_columns(records: list, time_key: str, time_format: str, var_names: list):
+    """Decode a list of observation records into NumPy columns in one pass.
+    Args:
+        records (list): list of dictionaries containing the observations
+        time_key (str): record attribute holding the observation time
+        time_format (str): strptime format of time_key (or 'ISO8601')
+        var_names (list): variable names to decode
+    Returns:
+        dict: 'valid_time' datetime64[ns] array and a float64 array per variable (NaN if missing)
+    """
+    rows = [[record.get(var_name) for var_name in var_names] for record in records]
+    # parsed as UTC (ISO8601 'Z' timestamps), stored as naive UTC datetime64
+    columns = {"valid_time": pd.to_datetime(np.array([record[time_key] for record in records], dtype=str),
+                                            format=time_format, utc=True).values.astype("datetime64[ns]")}
+    for i, var_name in enumerate(var_names):
+        columns[var_name] = to_float_column([row[i] for row in rows])
+    return columns
+
+
+def freq_mask(valid_time: np.ndarray, freq: str):
+    """ Mask of the times at the requested frequency ('hourly', '10min', None for all)
+    """
+    minutes = valid_time.astype("datetime64[m]").astype(np.int64) % 60
+    if freq == "hourly":
+        return minutes == 0
+    elif freq == "10min":
+        return minutes % 10 == 0
+    return np.ones(valid_time.shape, dtype=bool)
+
+
+def columns_to_dataset(columns: dict, var_names: list, freq: str = None, conv: dict = None):
+    """Build a time indexed dataset from observation columns.
+    Times are filtered at the requested frequency, sorted and deduplicated (first record kept).
+    Args:
+        columns (dict): 'valid_time' datetime64 array and a float64 array per variable
+        var_names (list): variable names to include
+        freq (str): frequency of the data ('hourly', '10min', None for all)
+        conv (dict, optional): unit conversion [factor, delta] for each variable
+    Returns:
+        Dataset: xarray Dataset with one variable per var_name, dim time
+    """
+    valid_time = columns["valid_time"].astype("datetime64[ns]")
+    index = np.flatnonzero(freq_mask(valid_time, freq))
+
+    # sort (stable, so the first record of duplicated times comes first) and deduplicate
+    index = index[np.argsort(valid_time[index], kind="stable")]
+    sorted_time = valid_time[index]
+    keep = np.ones(sorted_time.shape, dtype=bool)
+    keep[1:] = sorted_time[1:] != sorted_time[:-1]
+    index = index[keep]
+
+    data_vars = {}
+    for var_name in var_names:
+        data = columns[var_name][index]
+        if conv is not None and var_name in conv:
+            data = data * conv[var_name][0] + conv[var_name][1]
+        data_vars[var_name] = ("time", data)
+
+    return xr.Dataset(data_vars, coords={"time": valid_time[index]})
+
+
+class ColumnChunks:
+    """Chunked column buffer for streaming decoding: pages of decoded columns are filtered
+    at the requested frequency and appended as they arrive, so the raw records can be dropped
+    straight after decoding.
+
+    Args:
+        var_names (list): variable names to keep
+        freq (str): frequency of the data ('hourly', '10min', None for all)
+
+    Methods:
+        append(page_columns): filter and append a page of columns
+        to_dataset(conv): concatenate the chunks into a time indexed dataset
+    """
+
+    def __init__(self, var_names: list, freq: str = None):
+        self.var_names = list(var_names)
+        self.freq = freq
+        self.chunks = []
+        self.n_records = 0
+
+    def append(self, page_columns: dict):
+        mask = freq_mask(page_columns["valid_time"], self.freq)
+        self.chunks.append({key: page_columns[key][mask] for key in ["valid_time"] + self.var_names})
+        self.n_records += int(mask.sum())
+
+    def to_columns(self):
+        if not self.chunks:
+            columns = {var_name: np.array([], dtype=np.float64) for var_name in self.var_names}
+            columns["valid_time"] = np.array([], dtype="datetime64[ns]")
+            return columns
+        return {key: np.concatenate([chunk[key] for chunk in self.chunks]) for key in ["valid_time"] + self.var_names}
+
+    def to_dataset(self, conv: dict = None):
+        return columns_to_dataset(self.to_columns(), self.var_names, None, conv)
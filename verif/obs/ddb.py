@@ -2,99 +2,398 @@
 Functions for querying the DynamoDB table for observations.
 """
 
-from . import resource_ddb, TABLE_NAME, TABLE_NAME_recent
+from . import to_naive_utc, get_client_ddb, TABLE_NAME, TABLE_NAME_recent, DDB_RECENT_DAYS, DDB_MAX_WORKERS, DDB_SPLIT_DAYS
+from . import columns, utils
+from .cache import get_cache
 from .. import get_loggers
 import boto3
-from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import TypeDeserializer
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import numpy as np
+import pandas as pd
 import xarray as xr
 
 
 logger = get_loggers()
 
-def get_obs_all(obs_id: str, dt_start: datetime.datetime, dt_end: datetime.datetime, table_recent: bool = False):
-    """Get all observations from the DynamoDB table for a given obs_id and time range.
+# wire format -> python types (as returned by a boto3 Table resource)
+_deserializer = TypeDeserializer()
+
+
+def _split_range(dt_start: datetime.datetime, dt_end: datetime.datetime, split_days: int):
+    """ Split [dt_start, dt_end] into contiguous, non-overlapping valid_time key ranges
+        of at most split_days (the DDB between condition is inclusive on both ends)
+    Returns:
+        list: list of (dt_0, dt_1) valid_time key strings
+    """
+    step = datetime.timedelta(days=split_days)
+    sub_ranges = []
+    current = dt_start
+    while dt_end - current > step:
+        sub_ranges.append((current.strftime("%Y%m%d%H%M%S"),
+                           (current + step - datetime.timedelta(seconds=1)).strftime("%Y%m%d%H%M%S")))
+        current += step
+    sub_ranges.append((current.strftime("%Y%m%d%H%M%S"), dt_end.strftime("%Y%m%d%H%M%S")))
+    return sub_ranges
+
+
+def plan_query(dt_start: datetime.datetime, dt_end: datetime.datetime, table_recent: bool = False,
+               split_days: int = DDB_SPLIT_DAYS, recent_days: int = DDB_RECENT_DAYS):
+    """Plan the DynamoDB queries for a time range.
+    The valid_time range is clipped to the year of each archive table and to the retention
+    of the recent table, then split into sub-ranges of at most split_days that can be queried
+    independently.
     Args:
-        obs_id (str): The obs_id to query.
         dt_start (datetime.datetime): The start datetime.
         dt_end (datetime.datetime): The end datetime.
         table_recent (bool, optional): If True, also query the recent table. Defaults to False.
+        split_days (int, optional): max length of a sub-range in days.
+        recent_days (int, optional): retention of the recent table in days (env DDB_RECENT_DAYS).
     Returns:
-        list: A list of dictionaries containing the observations.
-    """    
-    # convert datetime to string
-    dt_0 = datetime.datetime.strftime(dt_start, "%Y%m%d%H%M%S")
-    dt_1 = datetime.datetime.strftime(dt_end, "%Y%m%d%H%M%S")
+        list: (table name, dt_0, dt_1) tuples, in table/key order.
+    """
+    dt_start = to_naive_utc(dt_start)
+    dt_end = to_naive_utc(dt_end)
 
-    ddb_tables = [TABLE_NAME.format(year=year) for year in range(dt_start.year, dt_end.year + 1)]
+    plan = []
+    for year in range(dt_start.year, dt_end.year + 1):
+        year_start = max(dt_start, datetime.datetime(year, 1, 1))
+        year_end = min(dt_end, datetime.datetime(year, 12, 31, 23, 59, 59))
+        plan.extend((TABLE_NAME.format(year=year), dt_0, dt_1)
+                    for dt_0, dt_1 in _split_range(year_start, year_end, split_days))
     if table_recent:
-        ddb_tables = ddb_tables + [TABLE_NAME_recent] 
+        # the recent table only holds the last recent_days (from the start of the UTC day)
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        recent_start = max(dt_start, (now - datetime.timedelta(days=recent_days)).replace(hour=0, minute=0,
+                                                                                          second=0, microsecond=0))
+        if recent_start <= dt_end:
+            plan.extend((TABLE_NAME_recent, dt_0, dt_1)
+                        for dt_0, dt_1 in _split_range(recent_start, dt_end, split_days))
+
+    return plan
+
+
+def iter_query_table(ddb_table_name: str, obs_id: str, dt_0: str, dt_1: str):
+    """Query one table for an obs_id and a valid_time key range, yielding one page (<= 1MB) at a time.
+    Args:
+        ddb_table_name (str): DynamoDB table name.
+        obs_id (str): The obs_id to query.
+        dt_0 (str): start valid_time key (%Y%m%d%H%M%S).
+        dt_1 (str): end valid_time key (%Y%m%d%H%M%S).
+    Yields:
+        list: A list of dictionaries containing the observations of a page.
+    """
+    # process-wide client (thread safe), items deserialized as with a Table resource
+    client = get_client_ddb()
+    query_args = dict(TableName=ddb_table_name,
+                      KeyConditionExpression="obs_id = :obs_id AND #vt BETWEEN :dt_0 AND :dt_1",
+                      ExpressionAttributeValues={":obs_id": {"S": obs_id},
+                                                 ":dt_0": {"S": dt_0},
+                                                 ":dt_1": {"S": dt_1}},
+                      ExpressionAttributeNames={"#vt": "valid_time"})
+
+    response = client.query(**query_args)
+    yield [{key: _deserializer.deserialize(value) for key, value in item.items()} for item in response["Items"]]
+
+    # if there are more than 1MB of data, then we need to query again
+    while "LastEvaluatedKey" in response:
+        response = client.query(ExclusiveStartKey=response["LastEvaluatedKey"], **query_args)
+        yield [{key: _deserializer.deserialize(value) for key, value in item.items()} for item in response["Items"]]
+
+
+def query_table(ddb_table_name: str, obs_id: str, dt_0: str, dt_1: str):
+    """Query one table for an obs_id and a valid_time key range, following the pagination.
+    Args:
+        ddb_table_name (str): DynamoDB table name.
+        obs_id (str): The obs_id to query.
+        dt_0 (str): start valid_time key (%Y%m%d%H%M%S).
+        dt_1 (str): end valid_time key (%Y%m%d%H%M%S).
+    Returns:
+        list: A list of dictionaries containing the observations.
+    """
+    result = []
+    for page in iter_query_table(ddb_table_name, obs_id, dt_0, dt_1):
+        result.extend(page)
+
+    return result
+
+
+def run_query_plan(obs_id: str, dt_start: datetime.datetime, dt_end: datetime.datetime, table_recent: bool = False,
+                   max_workers: int = DDB_MAX_WORKERS, split_days: int = DDB_SPLIT_DAYS):
+    """Run the query plan (see plan_query) concurrently on a bounded thread pool
+    and merge the pages back in table/key order.
+    Returns:
+        list: A list of dictionaries containing the observations.
+    """
+    plan = plan_query(dt_start, dt_end, table_recent, split_days)
 
     # query the DynamoDB tables
+    if max_workers <= 1 or len(plan) == 1:
+        pages = [query_table(ddb_table_name, obs_id, dt_0, dt_1) for ddb_table_name, dt_0, dt_1 in plan]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(plan))) as executor:
+            # map keeps the plan order
+            pages = list(executor.map(lambda query: query_table(query[0], obs_id, query[1], query[2]), plan))
 
     result = []
-    for ddb_table_name in ddb_tables:
-        # query the table for the obs_id and time range of interest
-        ddb_table = resource_ddb.Table(ddb_table_name)
-        response = ddb_table.query(
-            KeyConditionExpression=Key("obs_id").eq(obs_id)
-            & Key("valid_time").between(dt_0, dt_1)
-        )
-        result.extend(response["Items"])
-
-        # if there are more than 1MB of data, then we need to query again
-        while "LastEvaluatedKey" in response:
-            response = ddb_table.query(
-                KeyConditionExpression=Key("obs_id").eq(obs_id)
-                & Key("valid_time").between(dt_0, dt_1),
-                ExclusiveStartKey=response["LastEvaluatedKey"],
-            )
-            result.extend(response["Items"])
+    for page in pages:
+        result.extend(page)
 
     return result
 
 
-def extract_obs_data(obs_all: list, var_name: str, freq: str):
+def get_obs_all(obs_id: str, dt_start: datetime.datetime, dt_end: datetime.datetime, table_recent: bool = False,
+                max_workers: int = DDB_MAX_WORKERS, split_days: int = DDB_SPLIT_DAYS, use_cache: bool = True):
+    """Get all observations from the DynamoDB table for a given obs_id and time range.
+    The query plan (see plan_query) is run concurrently on a bounded thread pool and the
+    pages are merged back in table/key order.
+    If the local obs cache is enabled (env OBS_CACHE_DIR), only the time ranges
+    missing from the cache are queried.
+    Args:
+        obs_id (str): The obs_id to query.
+        dt_start (datetime.datetime): The start datetime.
+        dt_end (datetime.datetime): The end datetime.
+        table_recent (bool, optional): If True, also query the recent table. Defaults to False.
+        max_workers (int, optional): max number of concurrent queries (env DDB_MAX_WORKERS).
+        split_days (int, optional): max length of a sub-range in days (env DDB_SPLIT_DAYS).
+        use_cache (bool, optional): If False, bypass the local obs cache. Defaults to True.
+    Returns:
+        list: A list of dictionaries containing the observations.
+    """
+    obs_cache = None
+    if use_cache:
+        obs_cache = get_cache("DDB_obs" if table_recent else "DDB_obs_archive")
+
+    if obs_cache is None:
+        return run_query_plan(obs_id, dt_start, dt_end, table_recent, max_workers, split_days)
+
+    return obs_cache.get(obs_id, dt_start, dt_end,
+                         lambda gap_start, gap_end: run_query_plan(obs_id, gap_start, gap_end, table_recent,
+                                                                   max_workers, split_days))
+
+
+def projection_vars():
+    """ DDB observation variables referenced in the obs/models var catalogue
+    """
+    var_names = []
+    for model_vars in utils.catalogue.obs_vars.values():
+        for model_var in model_vars.values():
+            for var_name in model_var.get("DDB_obs", {}):
+                if var_name not in var_names:
+                    var_names.append(var_name)
+    return var_names
+
+
+def decode_page(items: list, var_names: list):
+    """Decode a page of low-level DynamoDB items (wire format) into NumPy columns.
+    Args:
+        items (list): items as returned by the DynamoDB client ({'valid_time': {'S': ...}, var: {'N': ...}})
+        var_names (list): variable names to decode
+    Returns:
+        dict: 'valid_time' datetime64[ns] array and a float64 array per variable (NaN if missing)
+    """
+    page_columns = {"valid_time": pd.to_datetime(np.array([item["valid_time"]["S"] for item in items], dtype=str),
+                                                 format="%Y%m%d%H%M%S").values.astype("datetime64[ns]")}
+    for var_name in var_names:
+        page_columns[var_name] = np.array([item[var_name].get("N", "nan") if var_name in item else "nan"
+                                           for item in items], dtype=str).astype(np.float64)
+    return page_columns
+
+
+def concat_columns(pages: list, var_names: list):
+    """ Concatenate decoded pages (see decode_page) into one set of columns
+    """
+    if not pages:
+        return decode_page([], var_names)
+    return {key: np.concatenate([page[key] for page in pages]) for key in ["valid_time"] + list(var_names)}
+
+
+def iter_table_columns(ddb_table_name: str, obs_id: str, dt_0: str, dt_1: str, var_names: list):
+    """Query one table with the low-level client, projecting only valid_time and var_names,
+    and yield each page decoded straight into NumPy columns.
+    Args:
+        ddb_table_name (str): DynamoDB table name.
+        obs_id (str): The obs_id to query.
+        dt_0 (str): start valid_time key (%Y%m%d%H%M%S).
+        dt_1 (str): end valid_time key (%Y%m%d%H%M%S).
+        var_names (list): variable names to project.
+    Yields:
+        dict: columns of a page (see decode_page)
+    """
+    client = get_client_ddb()
+    # attribute names as placeholders (reserved words, '@' in names)
+    attribute_names = {"#vt": "valid_time"}
+    attribute_names.update({f"#v{i}": var_name for i, var_name in enumerate(var_names)})
+    query_args = dict(TableName=ddb_table_name,
+                      KeyConditionExpression="obs_id = :obs_id AND #vt BETWEEN :dt_0 AND :dt_1",
+                      ExpressionAttributeValues={":obs_id": {"S": obs_id},
+                                                 ":dt_0": {"S": dt_0},
+                                                 ":dt_1": {"S": dt_1}},
+                      ProjectionExpression=", ".join(attribute_names),
+                      ExpressionAttributeNames=attribute_names)
+
+    response = client.query(**query_args)
+    yield decode_page(response["Items"], var_names)
+
+    # if there are more than 1MB of data, then we need to query again
+    while "LastEvaluatedKey" in response:
+        response = client.query(ExclusiveStartKey=response["LastEvaluatedKey"], **query_args)
+        yield decode_page(response["Items"], var_names)
+
+
+def query_table_columns(ddb_table_name: str, obs_id: str, dt_0: str, dt_1: str, var_names: list):
+    """Query one table with the low-level client, projecting only valid_time and var_names,
+    and decode each page straight into NumPy columns.
+    Args:
+        ddb_table_name (str): DynamoDB table name.
+        obs_id (str): The obs_id to query.
+        dt_0 (str): start valid_time key (%Y%m%d%H%M%S).
+        dt_1 (str): end valid_time key (%Y%m%d%H%M%S).
+        var_names (list): variable names to project.
+    Returns:
+        dict: columns (see decode_page)
+    """
+    return concat_columns(list(iter_table_columns(ddb_table_name, obs_id, dt_0, dt_1, var_names)), var_names)
+
+
+def get_obs_columns(obs_id: str, dt_start: datetime.datetime, dt_end: datetime.datetime, var_names: list = None,
+                    table_recent: bool = False, max_workers: int = DDB_MAX_WORKERS, split_days: int = DDB_SPLIT_DAYS):
+    """Get observations as NumPy columns with the low-level DynamoDB client (fast path of get_obs_all).
+    Only valid_time and the requested variables are returned by DynamoDB (ProjectionExpression),
+    and the wire format is decoded straight into typed arrays. The local obs cache is not used.
+    Args:
+        obs_id (str): The obs_id to query.
+        dt_start (datetime.datetime): The start datetime.
+        dt_end (datetime.datetime): The end datetime.
+        var_names (list, optional): variables to fetch. Defaults to the DDB_obs variables of obs_vars.yaml.
+        table_recent (bool, optional): If True, also query the recent table. Defaults to False.
+        max_workers (int, optional): max number of concurrent queries (env DDB_MAX_WORKERS).
+        split_days (int, optional): max length of a sub-range in days (env DDB_SPLIT_DAYS).
+    Returns:
+        dict: 'valid_time' datetime64[ns] array and a float64 array per variable, in table/key order
+    """
+    if var_names is None:
+        var_names = projection_vars()
+    plan = plan_query(dt_start, dt_end, table_recent, split_days)
+
+    def query(query_plan):
+        return query_table_columns(query_plan[0], obs_id, query_plan[1], query_plan[2], var_names)
+
+    if max_workers <= 1 or len(plan) == 1:
+        pages = [query(query_plan) for query_plan in plan]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(plan))) as executor:
+            pages = list(executor.map(query, plan))
+
+    return concat_columns(pages, var_names)
+
+
+def stream_obs_dataset(obs_id: str, dt_start: datetime.datetime, dt_end: datetime.datetime, var_names: list,
+                       freq: str = None, conv: dict = None, table_recent: bool = False,
+                       split_days: int = DDB_SPLIT_DAYS):
+    """Streaming (bounded memory) observation query: each DynamoDB page is projected to
+    var_names, decoded into NumPy columns, filtered at freq and appended to a chunk buffer,
+    and the raw page is dropped before the next one is queried.
+    Peak memory scales with the page size and the kept data, not with the query window.
+    Args:
+        obs_id (str): The obs_id to query.
+        dt_start (datetime.datetime): The start datetime.
+        dt_end (datetime.datetime): The end datetime.
+        var_names (list): variable names to extract.
+        freq (str): frequency of the data ('hourly', '10min', None for all)
+        conv (dict, optional): unit conversion [factor, delta] for each variable
+        table_recent (bool, optional): If True, also query the recent table. Defaults to False.
+        split_days (int, optional): max length of a sub-range in days (env DDB_SPLIT_DAYS).
+    Returns:
+        Dataset: xarray Dataset with one variable per var_name, dim time
+    """
+    obs_chunks = columns.ColumnChunks(var_names, freq)
+    for ddb_table_name, dt_0, dt_1 in plan_query(dt_start, dt_end, table_recent, split_days):
+        for page_columns in iter_table_columns(ddb_table_name, obs_id, dt_0, dt_1, var_names):
+            obs_chunks.append(page_columns)
+
+    return obs_chunks.to_dataset(conv)
+
+
+def get_obs_stations(wmo_codes: list, var_names: list, dt_start: datetime.datetime, dt_end: datetime.datetime,
+                     freq: str = None, table_recent: bool = True, max_workers: int = DDB_MAX_WORKERS):
+    """Get observations for several stations at once, as a station x time Dataset.
+    Stations are fetched concurrently (one worker per station, each running its query plan serially).
+    Args:
+        wmo_codes (list): WMO codes of the stations (resolved to obs_id with iceobs_stations.json).
+        var_names (list): observation variable names to extract.
+        dt_start (datetime.datetime): The start datetime.
+        dt_end (datetime.datetime): The end datetime.
+        freq (str): frequency of the data ('hourly', '10min', None for all)
+        table_recent (bool, optional): If True, also query the recent table. Defaults to True.
+        max_workers (int, optional): max number of stations fetched concurrently.
+    Returns:
+        Dataset: xarray Dataset with one variable per var_name, dims station/time
+                 (stations without observations are all NaN)
+    """
+    obs_stations = utils.catalogue.stations
+
+    stations = []
+    for wmo_code in wmo_codes:
+        if wmo_code in obs_stations:
+            stations.append(wmo_code)
+        else:
+            print(f'Station {wmo_code} not in iceobs_stations!')
+
+    def fetch_station(wmo_code):
+        obs_all = get_obs_all(f"{utils.catalogue.obs_id(wmo_code)}_nzaws", dt_start, dt_end,
+                              table_recent=table_recent, max_workers=1)
+        if not obs_all:
+            return None
+        return extract_obs_dataset(obs_all, var_names, freq)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(stations)))) as executor:
+        station_ds = list(executor.map(fetch_station, stations))
+
+    fetched = [(wmo_code, ds) for wmo_code, ds in zip(stations, station_ds) if ds is not None]
+    if not fetched:
+        print('No observations for the requested stations')
+        return
+
+    obs_ds = xr.concat([ds for _, ds in fetched],
+                       dim=pd.Index([wmo_code for wmo_code, _ in fetched], name='station'),
+                       join='outer')
+    # keep the requested station order, stations without data as NaN
+    obs_ds = obs_ds.reindex(station=stations)
+    obs_ds.attrs['observation source'] = 'DDB_obs'
+
+    return obs_ds
+
+
+def extract_obs_dataset(obs_all, var_names: list, freq: str = None, conv: dict = None):
+    """Extract several variables from the observations in a single pass.
+    The valid times are parsed once (vectorised) and the unit conversions applied in bulk.
+    Args:
+        obs_all (list or dict): all observations queried from the DynamoDB table
+                                (list of items from get_obs_all or columns from get_obs_columns)
+        var_names (list): variable names
+        freq (str): frequency of the data ('hourly', '10min', None for all)
+        conv (dict, optional): unit conversion [factor, delta] for each variable
+    Returns:
+        Dataset: xarray Dataset with one variable per var_name, dim time
+    """
+    if isinstance(obs_all, dict):
+        obs_columns = obs_all
+    else:
+        obs_columns = columns.records_to_columns(obs_all, "valid_time", "%Y%m%d%H%M%S", var_names)
+
+    return columns.columns_to_dataset(obs_columns, var_names, freq, conv)
+
+
+def extract_obs_data(obs_all, var_name: str, freq: str):
     """Extract the data from the observations.
     Args:
-        obs_all (list): all observations queried from the DynamoDB table
+        obs_all (list or dict): all observations queried from the DynamoDB table
+                                (list of items from get_obs_all or columns from get_obs_columns)
         var_name (str): variable name
         freq (str): frequency of the data ('hourly', '10min', None for all)
     Returns:
         DataArray: xarray DataArray containing the data
     """
-    valid_time = []
-    data = []
-    for obs in obs_all:
-        dt = datetime.datetime.strptime(obs["valid_time"], "%Y%m%d%H%M%S")
-        if freq == "hourly":
-            if dt.minute == 0:
-                valid_time.append(dt)
-                try:
-                    data.append(float(obs[var_name]))
-                except:
-                    data.append(np.nan)
-        elif freq == "10min":
-            if dt.minute%10 == 0:
-                valid_time.append(dt)
-                try:
-                    data.append(float(obs[var_name]))
-                except:
-                    data.append(np.nan)
-        else:
-            valid_time.append(dt)
-            try:
-                data.append(float(obs[var_name]))
-            except:
-                data.append(np.nan)
-
-    da = xr.DataArray(
-        data,
-        coords={
-            "time": valid_time,
-        },
-        dims=["time"],
-    ).drop_duplicates(dim='time').sortby('time')
-
-    return da
\ No newline at end of file
+    return extract_obs_dataset(obs_all, [var_name], freq)[var_name]
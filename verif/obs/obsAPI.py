@@ -1,8 +1,15 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import json
 import datetime
 import numpy as np
-import xarray as xr
+import pandas as pd
+
+from . import columns, API_TIME_FORMAT, API_MAX_WORKERS, API_MAX_RETRIES, API_BACKOFF_FACTOR
+from .cache import get_cache
 
 
 api_url = "https://test-api.metservice.com/observations/nz/1-minute/weatherStation/{station_id}"
@@ -14,16 +21,27 @@ class RequestAPI:
     Args:
         station_id (int): The ID of the weather station.
         apikey (str): The API Key to be used in the request.
+        use_cache (bool): use the local obs cache if enabled (env OBS_CACHE_DIR).
+        max_workers (int): max number of concurrent day requests (env API_MAX_WORKERS).
 
     Attributes:
-        session (requests.Session): The session to be used for the request.
+        session (requests.Session): The session to be used for the request (connection pool
+                                    sized to max_workers, retries with backoff on 429/5xx).
         base_url (str): The base URL for the API.
         headers (dict): The headers to be used in the request (i.e., API key).
+        last_timestamp (datetime.datetime): last obs_timestamp seen by sync.
+        sync_buffer (deque): (time, record) ring buffer of sync.
+        cache (ObsCache): local obs cache (None if disabled): elapsed UTC days are stored permanently,
+                          the current day is always refetched. Hit/miss counters in cache.stats().
 
     Methods:
         query_last(n_mins): Query the last n_mins minutes of data.
-        query_range(start, end): Query the data between start and end.
+        query_range(start, end): Query the data between start and end (through the cache).
+        sync(retention_mins): Fetch only the records newer than the last sync (ring buffer).
+        fetch_range(start, end): Fetch the data between start and end from the API.
+        stream_obs_dataset(start, end, var_names, freq): Streaming query of variables as a Xarray ds
         extract_obs_data(var_name, freq): Extract the variable at given freq as a Xarray da
+        extract_obs_dataset(var_names, freq): Extract several variables at given freq as a Xarray ds
 
     Example:
         >>> from verif.data.obs.obsAPI import RequestAPI
@@ -34,98 +52,185 @@ class RequestAPI:
 
     """
 
-    def __init__(self, station_id: int, apikey: str):
+    def __init__(self, station_id: int, apikey: str, use_cache: bool = True, max_workers: int = API_MAX_WORKERS):
+        self.station_id = station_id
+        self.max_workers = max_workers
         self.session = requests.Session()
+        retries = Retry(total=API_MAX_RETRIES,
+                        backoff_factor=API_BACKOFF_FACTOR,
+                        status_forcelist=[429, 500, 502, 503, 504],
+                        allowed_methods=["GET"])
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, max_workers), max_retries=retries)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
         self.base_url = api_url.format(station_id=str(station_id))
         self.headers = {"apikey": apikey}
         self.obs_all=[]
         self.da=None
+        self.cache = get_cache('API_obs') if use_cache else None
+        # delta sync state
+        self.last_timestamp = None
+        self.sync_buffer = deque()
 
     def query_last(self, n_mins: int):
         url = self.base_url + f"/last/{n_mins}/minutes?format=json"
         response = self.session.get(url, headers=self.headers)
+        response.raise_for_status()
         self.obs_all = json.loads(response.content)['results']
         return self.obs_all
 
+    def day_windows(self, start: datetime.datetime, end: datetime.datetime):
+        """ Split a date range into <= 1 day request windows
+        """
+        windows = []
+        current = start
+        while end-current > datetime.timedelta(days=1):
+            windows.append((current, current + datetime.timedelta(days=1)))
+            current += datetime.timedelta(days=1)
+        windows.append((current, end))
+        return windows
+
+    def fetch_window(self, start: datetime.datetime, end: datetime.datetime):
+        """ Fetch a <= 1 day window from the API
+            429/5xx responses are retried with backoff by the session, and raise once the retries are exhausted
+        """
+        url = (self.base_url +
+               f"/range/{start.strftime('%Y-%m-%dT%H:%M:%SZ')}/{end.strftime('%Y-%m-%dT%H:%M:%SZ')}?format=json"
+              )
+        response = self.session.get(url, headers=self.headers)
+        response.raise_for_status()
+        content = json.loads(response.content)
+        # no results: no data for this window
+        return content.get('results', [])
+
+    def iter_range(self, start: datetime.datetime, end: datetime.datetime):
+        """ Fetch a date range from the API, yielding the results of each (<= 1 day) request in time order
+            Up to max_workers windows are fetched concurrently ahead of the consumer
+        """
+        windows = self.day_windows(start, end)
+        if self.max_workers <= 1 or len(windows) == 1:
+            for window_start, window_end in windows:
+                yield self.fetch_window(window_start, window_end)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = deque()
+            for window_start, window_end in windows:
+                futures.append(executor.submit(self.fetch_window, window_start, window_end))
+                if len(futures) >= self.max_workers:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+
+    def fetch_range(self, start: datetime.datetime, end: datetime.datetime):
+        """ Fetch a date range from the API
+            Multiple (concurrent) queries for request > 1day, merged in time order
+        """
+        obs_range = []
+        for results in self.iter_range(start, end):
+            obs_range.extend(results)
+
+        return obs_range
+
+    def stream_obs_dataset(self, start: datetime.datetime, end: datetime.datetime, var_names: list,
+                           freq: str=None, conv: dict=None):
+        """ Streaming (bounded memory) query of a date range: the results of each day request are
+            decoded into NumPy columns, filtered at freq and appended to a chunk buffer, then dropped.
+            The local obs cache and self.obs_all are not used.
+            Args:
+                start (datetime.datetime): The start datetime.
+                end (datetime.datetime): The end datetime.
+                var_names (list): variable names
+                freq (str): frequency of the data ('hourly', '10min', None for all)
+                conv (dict, optional): unit conversion [factor, delta] for each variable
+            Returns:
+                Dataset: xarray Dataset with one variable per var_name, dim time
+        """
+        obs_chunks = columns.ColumnChunks(var_names, freq)
+        for results in self.iter_range(start, end):
+            obs_chunks.append(columns.records_to_columns(results, 'obs_timestamp', API_TIME_FORMAT, var_names))
+
+        return obs_chunks.to_dataset(conv)
+
+    def sync(self, retention_mins: int = 360, max_records: int = None):
+        """ Incremental (delta) sync for near-real-time monitoring
+            The first call fetches the last retention_mins minutes, then each call only fetches the
+            records newer than the last obs_timestamp seen. Records are kept in a ring buffer which
+            evicts the records older than the retention window (and the oldest above max_records),
+            so a refresh has a constant cost. self.obs_all is set to the buffer content.
+            Args:
+                retention_mins (int): retention window in minutes
+                max_records (int, optional): max number of records in the buffer
+            Returns:
+                list: the new records
+        """
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None, microsecond=0)
+        retention = datetime.timedelta(minutes=retention_mins)
+        if max_records is not None and self.sync_buffer.maxlen != max_records:
+            self.sync_buffer = deque(self.sync_buffer, maxlen=max_records)
+
+        if self.last_timestamp is None or self.last_timestamp < now - retention:
+            start = now - retention
+        else:
+            start = self.last_timestamp + datetime.timedelta(seconds=1)
+        new_obs = self.fetch_range(start, now)
+
+        if new_obs:
+            new_times = columns.records_to_columns(new_obs, 'obs_timestamp', API_TIME_FORMAT, [])['valid_time']
+            if self.last_timestamp is not None:
+                new_index = np.flatnonzero(new_times > np.datetime64(self.last_timestamp))
+                new_obs = [new_obs[i] for i in new_index]
+                new_times = new_times[new_index]
+            order = np.argsort(new_times, kind='stable')
+            self.sync_buffer.extend((new_times[i], new_obs[i]) for i in order)
+            if len(new_times):
+                self.last_timestamp = max(self.last_timestamp or datetime.datetime.min,
+                                          pd.Timestamp(new_times.max()).to_pydatetime())
+
+        # evict the records older than the retention window
+        oldest = np.datetime64(now - retention)
+        while self.sync_buffer and self.sync_buffer[0][0] < oldest:
+            self.sync_buffer.popleft()
+
+        self.obs_all = [obs for _, obs in self.sync_buffer]
+        return new_obs
+
     def query_range(self, start: datetime.datetime, end: datetime.datetime):
         """ Query a date range
             Multiple queries for request > 1day
+            If the local obs cache is enabled (env OBS_CACHE_DIR), only the time ranges
+            missing from the cache are requested.
         """
+        if self.cache is None:
+            obs_range = self.fetch_range(start, end)
+        else:
+            obs_range = self.cache.get(self.station_id, start, end, self.fetch_range)
 
         if end-start <= datetime.timedelta(days=1):
-            url = (self.base_url +
-                   f"/range/{start.strftime('%Y-%m-%dT%H:%M:%SZ')}/{end.strftime('%Y-%m-%dT%H:%M:%SZ')}?format=json"
-                  )
-            response = self.session.get(url, headers=self.headers)
-            content = json.loads(response.content)
-            try:
-                self.obs_all = content['results']
-            except KeyError:
-                pass
+            self.obs_all = obs_range
         else:
-            current = start
-            while end-current > datetime.timedelta(days=1):
-                current_end = current + datetime.timedelta(days=1)
-                url = (self.base_url +
-                       f"/range/{current.strftime('%Y-%m-%dT%H:%M:%SZ')}/{current_end.strftime('%Y-%m-%dT%H:%M:%SZ')}?format=json"
-                      )
-                response = self.session.get(url, headers=self.headers)
-                content = json.loads(response.content)
-                try:
-                    self.obs_all.extend(content['results'])
-                except KeyError:
-                    pass
-                current += datetime.timedelta(days=1)
-
-            url = (self.base_url +
-                   f"/range/{current.strftime('%Y-%m-%dT%H:%M:%SZ')}/{end.strftime('%Y-%m-%dT%H:%M:%SZ')}?format=json"
-                  )
-            response = self.session.get(url, headers=self.headers)
-            content = json.loads(response.content)
-            try:
-                self.obs_all.extend(content['results'])
-            except KeyError:
-                pass
+            self.obs_all.extend(obs_range)
 
         return self.obs_all
     
+    def extract_obs_dataset(self, var_names: list, freq: str=None, conv: dict=None):
+        """ Extract obs series for several vars at once (vectorised decoding of the results)
+            Args:
+                var_names (list): variable names
+                freq (str): frequency of the data ('hourly', '10min', None for all)
+                conv (dict, optional): unit conversion [factor, delta] for each variable
+            Returns:
+                Dataset: xarray Dataset with one variable per var_name, dim time
+        """
+        obs_columns = columns.records_to_columns(self.obs_all, 'obs_timestamp', API_TIME_FORMAT, var_names)
+        return columns.columns_to_dataset(obs_columns, var_names, freq, conv)
+
     def extract_obs_data(self, var_name: str, freq: str=None):
         """ Extract obs serie for given var and frequency 
             Args:
                 var_name (str): variable name
                 freq (str): frequency of the data ('hourly', '10min', None for all)
         """
-        valid_time = []
-        data = []
-        for obs in self.obs_all:
-            dt = datetime.datetime.fromisoformat(obs["obs_timestamp"][:-1])
-            if freq == "hourly":
-                if dt.minute == 0:
-                    valid_time.append(dt)
-                    try:
-                        data.append(float(obs[var_name]))
-                    except:
-                        data.append(np.nan)
-            elif freq == "10min":
-                if dt.minute % 10 == 0:
-                    valid_time.append(dt)
-                    try:
-                        data.append(float(obs[var_name]))
-                    except:
-                        data.append(np.nan)
-            else:
-                valid_time.append(dt)
-                try:
-                    data.append(float(obs[var_name]))
-                except:
-                    data.append(np.nan)
-
-        self.da = xr.DataArray(
-            data,
-            coords={
-                "time": valid_time,
-            },
-            dims=["time"],
-            ).drop_duplicates(dim='time').sortby('time')
-
-        return self.da
\ No newline at end of file
+        self.da = self.extract_obs_dataset([var_name], freq)[var_name]
+
+        return self.da
@@ -0,0 +1,152 @@
+"""
+Process-level in-memory store of observation series, shared by the verifications of a process
+(ex ePD, DLITE and MLPP verified at the same station).
+
+Series are memoised per (station, obs_source, obs_var, freq, time range) in their obs unit. A request
+for a sub-range of a stored series is sliced from it instead of queried again. The least recently
+used series are evicted once the store is above its size budget (OBS_STORE_MAX_MB).
+As in the local obs cache, a series reaching into the recent (still changing) window of its obs source
+expires once its TTL has elapsed (OBS_CACHE_RECENT_DAYS/OBS_CACHE_TTL_MINS, see cache.CACHE_SOURCES).
+"""
+
+import datetime
+import threading
+from collections import OrderedDict
+
+import xarray as xr
+
+from . import to_naive_utc, OBS_STORE_MAX_MB, OBS_CACHE_RECENT_DAYS, OBS_CACHE_TTL_MINS
+from .cache import CACHE_SOURCES
+from .. import get_loggers
+
+
+logger = get_loggers()
+
+
+class ObsStore:
+    """LRU, size-bounded memo of observation series.
+
+    Args:
+        max_bytes (int): size budget of the stored series in bytes.
+
+    Attributes:
+        hits (int): number of obs series served from the store.
+        misses (int): number of obs series queried.
+
+    Methods:
+        get(station_id, obs_source, var_names, dt_start, dt_end, freq, fetch): obs dataset,
+            querying only the series not in the store.
+        clear(): empty the store.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # (station_id, obs_source, var_name, freq, dt_start, dt_end) -> (DataArray (dim time), stored time)
+        self._series = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(da):
+        return da.nbytes + da["time"].nbytes
+
+    @staticmethod
+    def _is_valid(obs_source, dt_end, stored, now):
+        """ A series is valid forever if it ended before the recent retention of its obs source when
+            stored (UTC days), otherwise until its TTL has elapsed (same rule as the local obs cache)
+        """
+        settings = CACHE_SOURCES.get(obs_source, {})
+        recent = datetime.timedelta(days=settings.get("recent_days", OBS_CACHE_RECENT_DAYS))
+        ttl = datetime.timedelta(minutes=settings.get("ttl_mins", OBS_CACHE_TTL_MINS))
+        immutable_end = (stored - recent).replace(hour=0, minute=0, second=0, microsecond=0)
+        return dt_end < immutable_end or now - stored < ttl
+
+    def _pop(self, key):
+        da, _ = self._series.pop(key)
+        self._nbytes -= self._size(da)
+
+    def _lookup(self, station_id, obs_source, var_name, freq, dt_start, dt_end, now):
+        """ Stored series covering [dt_start, dt_end] (marked as recently used), sliced to the range
+            (expired series are dropped)
+        """
+        for key in reversed(self._series):
+            if (key[:4] == (station_id, obs_source, var_name, freq)
+                    and key[4] <= dt_start and dt_end <= key[5]):
+                da, stored = self._series[key]
+                if not self._is_valid(obs_source, key[5], stored, now):
+                    logger.debug(f"Obs store: expired {key}")
+                    self._pop(key)
+                    return
+                self._series.move_to_end(key)
+                return da.sel(time=slice(dt_start, dt_end))
+
+    def _add(self, key, da, now):
+        if key in self._series:
+            self._pop(key)
+        # series expiring straight away (no TTL) are not stored
+        if not self._is_valid(key[1], key[5], now, now):
+            return
+        self._series[key] = (da, now)
+        self._nbytes += self._size(da)
+        # evict the least recently used series above the size budget (the new one is kept)
+        while self._nbytes > self.max_bytes and len(self._series) > 1:
+            evicted_key, (evicted, _) = self._series.popitem(last=False)
+            self._nbytes -= self._size(evicted)
+            logger.debug(f"Obs store: evict {evicted_key}")
+
+    def get(self, station_id, obs_source: str, var_names: list, dt_start, dt_end, freq: str, fetch):
+        """ Obs series of var_names for [dt_start, dt_end] (obs units)
+        Args:
+            station_id (str): WMO station id.
+            obs_source (str): obs data source ('DDB_obs', 'API_obs')
+            var_names (list): obs variable names
+            dt_start (datetime.datetime): The start datetime.
+            dt_end (datetime.datetime): The end datetime.
+            freq (str): frequency requested (None: all points, 'hourly', '10min')
+            fetch (callable): fetch(var_names) querying the obs source for [dt_start, dt_end],
+                              returning a dataset with one variable per var_name (None if no data)
+        Returns:
+            Dataset: xarray Dataset with one variable per var_name, dim time (None if no data)
+        """
+        dt_start = to_naive_utc(dt_start)
+        dt_end = to_naive_utc(dt_end)
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+        with self._lock:
+            series = {}
+            for var_name in var_names:
+                da = self._lookup(station_id, obs_source, var_name, freq, dt_start, dt_end, now)
+                if da is not None:
+                    series[var_name] = da
+            missing = [var_name for var_name in var_names if var_name not in series]
+            self.hits += len(series)
+            self.misses += len(missing)
+
+        if missing:
+            # all the missing obs vars queried at once
+            logger.debug(f"Obs store miss {station_id}/{obs_source}: {missing} {dt_start} - {dt_end}")
+            obs_ds = fetch(missing)
+            if obs_ds is None:
+                return
+            with self._lock:
+                for var_name in missing:
+                    series[var_name] = obs_ds[var_name]
+                    self._add((station_id, obs_source, var_name, freq, dt_start, dt_end), obs_ds[var_name], now)
+
+        return xr.Dataset({var_name: series[var_name] for var_name in var_names})
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+            self._nbytes = 0
+
+    def stats(self):
+        """ Hit/miss counters (per obs series) and size of the store
+        """
+        return {"hits": self.hits, "misses": self.misses, "series": len(self._series), "nbytes": self._nbytes}
+
+
+# process-wide obs store
+obs_store = ObsStore(int(OBS_STORE_MAX_MB * 1024**2))
@@ -6,8 +6,17 @@ import pkg_resources
 import yaml
 import datetime
 import json
+import threading
+from collections import namedtuple
+import numpy as np
+from scipy.spatial import cKDTree
 
 from verif.obs import ddb
+from verif.obs.store import obs_store
+
+# obs variable for a model variable: name, unit conversion [factor, delta], model unit, obs unit
+ObsVar = namedtuple('ObsVar', ['name', 'conv', 'unit', 'obs_unit'])
+
 
 def load_obs_vars():
     ''' Loads the obs/models var catalogue
@@ -26,11 +35,175 @@ def load_iceobs_stations():
         obs_vars = json.load(f)
     return obs_vars
 
+
+class StationIndex:
+    """ Spatial index (KD-tree) over station coordinates for nearest-station and region selection.
+        Coordinates are indexed as 3D points on the unit sphere, so chord distances are
+        monotonic with great-circle distances.
+
+    Args:
+        stations (dict): stations by wmo code, with 'id'/'lat'/'lon' (iceobs_stations.json format),
+                         the stations without 'id' (wmo code) are not indexed
+
+    Methods:
+        nearest(lat, lon, k): k nearest stations of one or several points
+        within_radius(lat, lon, radius_km): stations within a great-circle radius of a point
+        in_bbox(lat_min, lat_max, lon_min, lon_max): stations in a lat/lon bounding box
+    """
+    EARTH_RADIUS_KM = 6371.0
+
+    def __init__(self, stations: dict):
+        # stations are keyed by both wmo code and name, one entry per 'id' (stations without wmo code are skipped)
+        unique_stations = {station['id']: station for station in stations.values()
+                           if station.get('id') is not None
+                           and station.get('lat') is not None and station.get('lon') is not None}
+        self.wmo_codes = np.array(list(unique_stations.keys()))
+        self.lat = np.array([station['lat'] for station in unique_stations.values()], dtype=np.float64)
+        self.lon = np.array([station['lon'] for station in unique_stations.values()], dtype=np.float64)
+        self.tree = cKDTree(self._to_xyz(self.lat, self.lon))
+
+    @staticmethod
+    def _to_xyz(lat, lon):
+        lat = np.radians(np.asarray(lat, dtype=np.float64))
+        lon = np.radians(np.asarray(lon, dtype=np.float64))
+        return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+    def _chord_to_km(self, chord):
+        return 2 * self.EARTH_RADIUS_KM * np.arcsin(np.clip(chord / 2, 0, 1))
+
+    def nearest(self, lat, lon, k: int = 1):
+        """ k nearest stations of one point or an array of points (ex grid points)
+        Returns:
+            tuple: wmo codes and great-circle distances (km), shape lat.shape + (k,)
+        """
+        chord, index = self.tree.query(self._to_xyz(lat, lon), k=[i + 1 for i in range(k)])
+        return self.wmo_codes[index], self._chord_to_km(chord)
+
+    def within_radius(self, lat: float, lon: float, radius_km: float):
+        """ Stations within a great-circle radius (km) of a point, nearest first
+        Returns:
+            list: wmo codes
+        """
+        chord = 2 * np.sin(min(radius_km / self.EARTH_RADIUS_KM, np.pi) / 2)
+        index = np.array(self.tree.query_ball_point(self._to_xyz(lat, lon), chord), dtype=int)
+        distances = np.linalg.norm(self.tree.data[index] - self._to_xyz(lat, lon), axis=-1)
+        return list(self.wmo_codes[index[np.argsort(distances)]])
+
+    def in_bbox(self, lat_min: float, lat_max: float, lon_min: float, lon_max: float):
+        """ Stations in a lat/lon bounding box (lon_min > lon_max for a box across the antimeridian)
+        Returns:
+            list: wmo codes
+        """
+        in_lat = (self.lat >= lat_min) & (self.lat <= lat_max)
+        if lon_min <= lon_max:
+            in_lon = (self.lon >= lon_min) & (self.lon <= lon_max)
+        else:
+            in_lon = (self.lon >= lon_min) | (self.lon <= lon_max)
+        return list(self.wmo_codes[in_lat & in_lon])
+
+
+class ObsCatalogue:
+    """ Station and obs/models variable catalogue, loaded lazily and once per process
+        (use the module instance `catalogue`), with O(1) lookups and reverse indexes.
+
+    Attributes:
+        stations (dict): iceobs stations by wmo code (iceobs_stations.json)
+        obs_vars (dict): obs/models var catalogue (obs_vars.yaml)
+        station_index (StationIndex): spatial index over the station coordinates
+
+    Methods:
+        obs_id(wmo_code): DDB obs_id of a station
+        wmo_code(obs_id): wmo code of a DDB obs_id (with or without the '_nzaws' suffix),
+                          first station of the catalogue for a duplicated name
+        obs_var(model, model_var, obs_source): ObsVar (name, conv, unit, obs_unit) to verify a model var
+        reload(): reload the catalogue files (long-lived processes)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def _load(self):
+        with self._lock:
+            if self._loaded:
+                return
+            self._stations = load_iceobs_stations()
+            self._obs_vars = load_obs_vars()
+            # stations are keyed by both wmo code and name, 'id' is the wmo code:
+            # stations without wmo code are left out, the first station of a duplicated name is kept
+            self._wmo_codes = {}
+            for station in self._stations.values():
+                if station.get('id') is not None and station.get('name') is not None:
+                    self._wmo_codes.setdefault(station['name'], station['id'])
+            self._model_obs_vars = {}
+            for model, model_vars in self._obs_vars.items():
+                for model_var, model_var_def in model_vars.items():
+                    for obs_source, obs_source_vars in model_var_def.items():
+                        if obs_source == 'unit':
+                            continue
+                        # first obs var of the source is the one to verify against
+                        name, obs_var_def = next(iter(obs_source_vars.items()))
+                        self._model_obs_vars[(model, model_var, obs_source)] = ObsVar(name,
+                                                                                      obs_var_def['conv'],
+                                                                                      model_var_def['unit'],
+                                                                                      obs_var_def['unit'])
+            self._station_index = None
+            self._loaded = True
+
+    def reload(self):
+        """ Reload the catalogue files on next access
+        """
+        with self._lock:
+            self._loaded = False
+
+    @property
+    def stations(self):
+        if not self._loaded:
+            self._load()
+        return self._stations
+
+    @property
+    def obs_vars(self):
+        if not self._loaded:
+            self._load()
+        return self._obs_vars
+
+    @property
+    def station_index(self):
+        if not self._loaded:
+            self._load()
+        if self._station_index is None:
+            self._station_index = StationIndex(self._stations)
+        return self._station_index
+
+    def obs_id(self, wmo_code):
+        """ DDB obs_id from the wmo code (KeyError if unknown)
+        """
+        return self.stations[wmo_code]['name']
+
+    def wmo_code(self, obs_id):
+        """ wmo code from the DDB obs_id (KeyError if unknown or without wmo code)
+            For a name shared by several stations (ex 'NZUKF'), the first one of the catalogue is returned
+        """
+        if not self._loaded:
+            self._load()
+        return self._wmo_codes[obs_id.replace('_nzaws', '')]
+
+    def obs_var(self, model, model_var, obs_source):
+        """ ObsVar (name, conv, unit, obs_unit) for a model var and obs source (KeyError if unknown)
+        """
+        if not self._loaded:
+            self._load()
+        return self._model_obs_vars[(model, model_var, obs_source)]
+
+
+catalogue = ObsCatalogue()
+
+
 def get_obs_id(wmo_code):
     """ Get the DDB obs_id from the wmo code
     """
-    obs_id = load_iceobs_stations()[wmo_code]['name']
-    return obs_id
+    return catalogue.obs_id(wmo_code)
 
 
 def get_obs_serie(wmo_code: str,
@@ -54,36 +227,34 @@ def get_obs_serie(wmo_code: str,
     Returns:
         DataArray: xarray DataArray containing the data with metadata of obs var
     """
-    obs_vars = load_obs_vars()
-    obs_stations = load_iceobs_stations()
-    
     # get the obs_id from the wmo code
     try:
-        obs_id = obs_stations[wmo_code]['name']
+        obs_id = catalogue.obs_id(wmo_code)
     except KeyError:
         print('Station not in iceobs_stations!')
         return
     
     # get the obs var to retrieve
     try:
-        obs_var = list(obs_vars[model][model_var][obs_source].keys())[0]
+        obs_var = catalogue.obs_var(model, model_var, obs_source)
     except KeyError:
         print('Variable/model/obs_source not in the obs_var list!')
         return
     
     if obs_source=='DDB_obs':
-        obs_all = ddb.get_obs_all(f'{obs_id}_nzaws', dt_start, dt_end, table_recent = True)
-        obs_var_serie = ddb.extract_obs_data(obs_all, obs_var, freq)
+        def fetch(var_names):
+            obs_all = ddb.get_obs_all(f'{obs_id}_nzaws', dt_start, dt_end, table_recent = True)
+            return ddb.extract_obs_dataset(obs_all, var_names, freq)
 
+        # through the process-level obs store (shared with the other verifications of the station)
+        obs_var_ds = obs_store.get(wmo_code, obs_source, [obs_var.name], dt_start, dt_end, freq, fetch)
         # convert to the model unit
-        obs_var_serie = (obs_var_serie * obs_vars[model][model_var][obs_source][obs_var]['conv'][0]
-                           + obs_vars[model][model_var][obs_source][obs_var]['conv'][1]
-                           )
+        obs_var_serie = obs_var_ds[obs_var.name] * obs_var.conv[0] + obs_var.conv[1]
         # add metedata
         obs_var_serie.attrs['observation source'] = f'{obs_source} - converted units'
-        obs_var_serie.attrs['observation var'] = obs_var
-        obs_var_serie.attrs['unit'] = obs_vars[model][model_var]['unit']
+        obs_var_serie.attrs['observation var'] = obs_var.name
+        obs_var_serie.attrs['unit'] = obs_var.unit
 
     #elif obs_source='API_obs':
 
-    return obs_var_serie
+    return obs_var_serie
\ No newline at end of file
@@ -0,0 +1,107 @@
+"""
+Pipelined executor overlapping I/O and compute: a small pool of I/O threads prefetches the inputs
+of the next units while the calling thread processes the current one.
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PrefetchPipeline:
+    """Two-stage (fetch -> process) pipeline with bounded prefetch.
+
+    Args:
+        fetch (callable): I/O stage, fetch(item) -> inputs (run on the I/O threads)
+        process (callable): compute stage, process(item, inputs) -> result (run on the calling thread)
+        prefetch (int): max number of units fetched ahead of the one processed (backpressure)
+        io_workers (int): number of I/O threads
+
+    Attributes:
+        stats (dict): per stage number of units, busy time and throughput of the last run,
+                      plus the wall time and the time the compute stage waited for the I/O
+
+    Example:
+        >>> pipeline = PrefetchPipeline(fetch_unit, score_unit, prefetch=4, io_workers=4)
+        >>> for item, result, error in pipeline.run(units):
+        ...     print(item, result, error)
+    """
+
+    def __init__(self, fetch, process, prefetch: int = 2, io_workers: int = 2):
+        self.fetch = fetch
+        self.process = process
+        self.prefetch = max(1, prefetch)
+        self.io_workers = max(1, io_workers)
+        self._lock = threading.Lock()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._busy = {"fetch": 0., "process": 0.}
+        self._units = {"fetch": 0, "process": 0}
+        self._wait = 0.
+        self._wall = 0.
+
+    def _timed_fetch(self, item):
+        start = time.perf_counter()
+        try:
+            return self.fetch(item)
+        finally:
+            with self._lock:
+                self._busy["fetch"] += time.perf_counter() - start
+                self._units["fetch"] += 1
+
+    def run(self, items):
+        """ Fetch and process the items in order, with up to `prefetch` items fetched ahead
+        Yields:
+            tuple: (item, result, error), error is the exception raised by a stage (result None)
+        """
+        self._reset_stats()
+        run_start = time.perf_counter()
+        items = iter(items)
+        pending = deque()
+
+        with ThreadPoolExecutor(max_workers=self.io_workers) as executor:
+            def submit_next():
+                for item in items:
+                    pending.append((item, executor.submit(self._timed_fetch, item)))
+                    return
+
+            for _ in range(self.prefetch):
+                submit_next()
+
+            while pending:
+                item, future = pending.popleft()
+                wait_start = time.perf_counter()
+                try:
+                    inputs = future.result()
+                except Exception as error:
+                    self._wait += time.perf_counter() - wait_start
+                    submit_next()
+                    yield item, None, error
+                    continue
+                self._wait += time.perf_counter() - wait_start
+                # keep the I/O busy with the next units while this one is processed
+                submit_next()
+
+                process_start = time.perf_counter()
+                try:
+                    result, error = self.process(item, inputs), None
+                except Exception as process_error:
+                    result, error = None, process_error
+                self._busy["process"] += time.perf_counter() - process_start
+                self._units["process"] += 1
+                del inputs
+                yield item, result, error
+
+        self._wall = time.perf_counter() - run_start
+
+    @property
+    def stats(self):
+        stats = {stage: {"units": self._units[stage],
+                         "busy_s": round(self._busy[stage], 3),
+                         "units_per_s": round(self._units[stage] / self._busy[stage], 3) if self._busy[stage] else None}
+                 for stage in ["fetch", "process"]}
+        stats["wall_s"] = round(self._wall, 3)
+        stats["io_wait_s"] = round(self._wait, 3)
+        return stats